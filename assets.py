@@ -0,0 +1,278 @@
+"""Shared asset cache for the platformer.
+
+Images are loaded from disk once, converted to the display's pixel format
+and then handed out as shared Surfaces, so creating a sprite never touches
+the disk after its image has been seen once.
+
+Small images are packed into the pages of a texture Atlas as they're
+loaded, so the sprites (and the tiles, whose tilesets load their images
+through the cache) are drawn from a few large Surfaces rather than many
+small ones.
+
+Sound effects are cached the same way. preload() decodes a batch of image
+and sound files on a pool of threads, for a level to load everything it
+uses up front, while the main thread converts the images as they arrive.
+
+Surfaces returned by the cache are shared between every user; blit from
+them but never draw onto them.
+"""
+# This file is part of platformer and is distributed under the same terms
+# (GNU General Public License version 3 or later) as platformer.py.
+
+import sys
+import threading
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import pygame
+
+
+# raise the exception described by the sys.exc_info() tuple info with its
+# original traceback; Python 2's three-argument raise is a syntax error in
+# Python 3, so it's compiled only there
+if sys.version_info[0] < 3:
+    exec('def _reraise(info):\n    raise info[0], info[1], info[2]\n')
+else:
+    def _reraise(info):
+        raise info[1].with_traceback(info[2])
+
+
+class Atlas(object):
+    '''Packs images into the pages of a texture atlas: a few large Surfaces
+    holding many images side by side.
+
+    Images are placed on shelves, rows as tall as the tallest image on them,
+    filled left to right; a new page is started when a page is full. Images
+    larger than a page are left unpacked. Space is never reclaimed.
+
+    Atlases have some basic properties:
+
+        pages - the page Surfaces
+        page_size - the (width, height) of each page
+        padding - the transparent pixels left between images
+        packed - the number of images packed
+    '''
+    def __init__(self, page_size=(512, 512), padding=1):
+        self.page_size = page_size
+        self.padding = padding
+        self.pages = []
+        self.packed = 0
+        # the shelves of the last page as [top, height, next free x]
+        self._shelves = []
+
+    def _new_page(self):
+        page = pygame.Surface(self.page_size, pygame.SRCALPHA, 32)
+        page = convert(page)
+        page.fill((0, 0, 0, 0))
+        self.pages.append(page)
+        self._shelves = []
+        return page
+
+    def _place(self, w, h):
+        # the (x, y) to put a w by h image at on the last page, or None
+        width, height = self.page_size
+        pad = self.padding
+        top = 0
+        for shelf in self._shelves:
+            if h <= shelf[1] and shelf[2] + w <= width:
+                x = shelf[2]
+                shelf[2] += w + pad
+                return x, shelf[0]
+            top = shelf[0] + shelf[1] + pad
+        if top + h > height:
+            return None
+        self._shelves.append([top, h, w + pad])
+        return 0, top
+
+    def add(self, surface):
+        '''Copy the image into the atlas and return the subsurface of the
+        page holding it, or return the image itself if it's too large to
+        pack.
+        '''
+        w, h = surface.get_size()
+        width, height = self.page_size
+        if w > width or h > height or not w or not h:
+            return surface
+        pos = self._place(w, h) if self.pages else None
+        if pos is None:
+            self._new_page()
+            pos = self._place(w, h)
+        page = self.pages[-1]
+        # the page is transparent black, so taking the maximum of each
+        # channel copies the image's pixels and alpha exactly
+        page.blit(surface, pos, None, pygame.BLEND_RGBA_MAX)
+        self.packed += 1
+        return page.subsurface(pygame.Rect(pos, (w, h)))
+
+
+class AssetCache(object):
+    '''A cache of display-converted image Surfaces keyed by filename.
+
+    AssetCaches have some basic properties:
+
+        max_items - if set, the least recently used entries are evicted once
+                    more than this many images (or sliced image strips) are
+                    held
+        atlas - if set, an Atlas the images loaded with alpha are packed
+                into; images evicted from the cache keep their atlas space
+        hits, misses, evictions - counters describing how the cache is doing
+    '''
+    def __init__(self, max_items=None, atlas=None):
+        self.max_items = max_items
+        self.atlas = atlas
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, filename):
+        return (filename, True) in self._items or \
+            (filename, False) in self._items
+
+    def _get(self, key, load):
+        try:
+            item = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            item = load()
+        else:
+            self.hits += 1
+        # (re-)insert as the most recently used entry
+        self._items[key] = item
+        if self.max_items is not None:
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                self.evictions += 1
+        return item
+
+    def image(self, filename, alpha=True):
+        '''Return the shared Surface for the image file.
+
+        The image is converted with convert_alpha() (or convert() if alpha
+        is False) once a display mode has been set, and packed into the atlas
+        if the cache has one and alpha is True.
+        '''
+        return self._get((filename, alpha),
+            lambda: self._prepare(pygame.image.load(filename), alpha))
+
+    def _prepare(self, image, alpha):
+        image = convert(image, alpha)
+        if alpha and self.atlas is not None:
+            image = self.atlas.add(image)
+        return image
+
+    def sound(self, filename):
+        '''Return the shared Sound for the sound file.
+        '''
+        return self._get(('sound', filename),
+            lambda: pygame.mixer.Sound(filename))
+
+    def preload(self, images=(), sounds=(), threads=4, progress=None):
+        '''Load those of the image and sound files given which aren't
+        cached, decoding them on a pool of threads.
+
+        The decoded images are converted and packed into the atlas, as
+        image() would, on the calling thread since conversion uses the
+        display. If given, progress(done, total) is called on the calling
+        thread as each file is done.
+        '''
+        jobs = [(pygame.image.load, filename) for filename in images
+            if (filename, True) not in self._items]
+        jobs.extend((pygame.mixer.Sound, filename) for filename in sounds
+            if ('sound', filename) not in self._items)
+        if not jobs:
+            return
+        # each job's (decoded item, sys.exc_info() of its exception), set as
+        # it finishes
+        results = [None] * len(jobs)
+        finished = [threading.Event() for job in jobs]
+        pending = queue.Queue()
+        for i in range(len(jobs)):
+            pending.put(i)
+        def work():
+            while True:
+                try:
+                    i = pending.get_nowait()
+                except queue.Empty:
+                    return
+                load, filename = jobs[i]
+                try:
+                    results[i] = (load(filename), None)
+                except Exception:
+                    results[i] = (None, sys.exc_info())
+                finished[i].set()
+        for i in range(max(1, min(threads, len(jobs)))):
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+        # take the results in order so the atlas is packed the same way
+        # every time
+        for i, (load, filename) in enumerate(jobs):
+            finished[i].wait()
+            item, error = results[i]
+            if error is not None:
+                _reraise(error)
+            if load is pygame.image.load:
+                self._get((filename, True), lambda: self._prepare(item, True))
+            else:
+                self._get(('sound', filename), lambda: item)
+            if progress is not None:
+                progress(i + 1, len(jobs))
+
+    def sliced(self, filename, w, h):
+        '''Return the list of w by h frames sliced left to right from the
+        image file. Frames are subsurfaces of the shared image.
+        '''
+        def load():
+            master = self.image(filename)
+            master_width, master_height = master.get_size()
+            return [master.subsurface((i * w, 0, w, h))
+                for i in range(master_width // w)]
+        return self._get(('sliced', filename, w, h), load)
+
+    def stats(self):
+        '''Return a dict of the cache's hit, miss and eviction counts and
+        its current size.
+        '''
+        return dict(hits=self.hits, misses=self.misses,
+            evictions=self.evictions, size=len(self._items))
+
+    def clear(self):
+        self._items.clear()
+
+
+def convert(surface, alpha=True):
+    '''Convert the Surface to the display's pixel format, if there is a
+    display to convert to.
+    '''
+    if pygame.display.get_surface() is None:
+        return surface
+    if alpha:
+        return surface.convert_alpha()
+    return surface.convert()
+
+
+# the cache shared by all the game's sprites
+cache = AssetCache(atlas=Atlas())
+
+
+def image(filename, alpha=True):
+    return cache.image(filename, alpha)
+
+
+def sliced(filename, w, h):
+    return cache.sliced(filename, w, h)
+
+
+def sound(filename):
+    return cache.sound(filename)
+
+
+def preload(images=(), sounds=(), threads=4, progress=None):
+    return cache.preload(images, sounds, threads, progress)
@@ -0,0 +1,623 @@
+#!/usr/bin/python
+"""Platformer benchmarks
+
+Generates TMX maps of increasing size (compatible with new-map.tmx and
+new-tiles.tsx) and measures, under the SDL dummy drivers:
+
+  - map loading, and per-frame game update and draw
+  - enemy and bullet updates, per sprite and batched with NumPy
+  - trigger layer queries, and the same lookups in a TriggerGrid (counting
+    any that don't agree)
+  - the memory and attribute access cost of Cells and Objects against
+    dict-based equivalents
+  - the load time and resident memory of streamed maps as the view moves
+  - decoding tile layer data in each of the TMX encodings
+  - drawing sprites from separate images against drawing them from a
+    texture atlas
+  - loading a level's images and sounds one at a time against loading them
+    on a pool of threads
+
+Results are written as JSON so they can be compared between runs.
+
+    python benchmark.py [--output results.json] [--scale WxH:T:E:C ...]
+"""
+# This file is part of platformer and is distributed under the same terms
+# (GNU General Public License version 3 or later) as platformer.py.
+
+import io
+import os
+import sys
+import gzip
+import json
+import zlib
+import base64
+import random
+import shutil
+import struct
+import argparse
+import platform
+import tempfile
+from timeit import default_timer as timer
+
+# the game's directory, which the benchmarks must be run from so the maps'
+# tileset and image paths resolve
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+import pygame
+import tmx
+import assets
+import platformer
+
+
+TILE = 32
+
+# (width, height, triggers, enemies, coins); the first is about the size of
+# new-map.tmx
+DEFAULT_SCALES = [
+    (40, 35, 100, 14, 26),
+    (200, 200, 1000, 100, 200),
+    (500, 500, 5000, 500, 1000),
+]
+
+
+def generate_map(filename, width, height, triggers, enemies, coins, seed=0):
+    '''Write a TMX map of width by height tiles using new-tiles.tsx.
+
+    The "triggers" layer holds solid blocks around the edge, "triggers"
+    one-way platforms and ladders, an enemy on each of "enemies" patrol lanes
+    bounded by "reverse" triggers, "coins" coins and a player start and exit.
+    '''
+    rnd = random.Random(seed)
+    px_width, px_height = width * TILE, height * TILE
+
+    # the tile layer: a solid border and scattered scenery
+    gids = []
+    for y in range(height):
+        for x in range(width):
+            if x in (0, width - 1) or y in (0, height - 1):
+                gids.append(1)
+            elif rnd.random() < 0.3:
+                gids.append(rnd.randint(1, 20))
+            else:
+                gids.append(0)
+    data = struct.pack('<%di' % len(gids), *gids)
+    data = base64.b64encode(zlib.compress(data)).decode('ascii')
+
+    objects = []
+    def add(name, x, y, w, h, prop, value=''):
+        objects.append((name, x, y, w, h, prop, value))
+
+    add('block', 0, 0, px_width, TILE, 'blockers', 'tlbr')
+    add('block', 0, px_height - TILE, px_width, TILE, 'blockers', 'tlbr')
+    add('block', 0, 0, TILE, px_height, 'blockers', 'tlbr')
+    add('block', px_width - TILE, 0, TILE, px_height, 'blockers', 'tlbr')
+    for i in range(max(0, triggers - 4)):
+        x = rnd.randint(1, width - 7) * TILE
+        y = rnd.randint(2, height - 3) * TILE
+        if rnd.random() < 0.1:
+            add('ladder', x, y, TILE, TILE * 3, 'action', 'l')
+        else:
+            add('platform', x, y, TILE * rnd.randint(2, 6), TILE, 'blockers',
+                't')
+    for i in range(enemies):
+        x = rnd.randint(2, width - 8) * TILE
+        y = rnd.randint(2, height - 2) * TILE
+        add('enemy', x + 2 * TILE, y, TILE, TILE, 'enemy')
+        add('reverse', x, y, TILE, TILE, 'reverse')
+        add('reverse', x + 5 * TILE, y, TILE, TILE, 'reverse')
+    for i in range(coins):
+        add('coin', rnd.randint(1, width - 2) * TILE,
+            rnd.randint(1, height - 2) * TILE, TILE, TILE, 'coin')
+    add('player', 2 * TILE, px_height - 2 * TILE, TILE, TILE, 'player')
+    add('exit', px_width - 3 * TILE, TILE, TILE, TILE, 'exit')
+
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<map version="1.0" orientation="orthogonal" width="%d" '
+            'height="%d" tilewidth="%d" tileheight="%d">\n' % (width, height,
+            TILE, TILE))
+        f.write(' <tileset firstgid="1" source="new-tiles.tsx"/>\n')
+        f.write(' <layer name="set" width="%d" height="%d">\n' % (width,
+            height))
+        f.write('  <data encoding="base64" compression="zlib">\n   %s\n'
+            '  </data>\n </layer>\n' % data)
+        f.write(' <objectgroup name="triggers" width="%d" height="%d" '
+            'visible="0">\n' % (width, height))
+        for name, x, y, w, h, prop, value in objects:
+            f.write('  <object name="%s" x="%d" y="%d" width="%d" height="%d">\n'
+                '   <properties>\n    <property name="%s" value="%s"/>\n'
+                '   </properties>\n  </object>\n' % (name, x, y, w, h, prop,
+                value))
+        f.write(' </objectgroup>\n</map>\n')
+
+
+def best_of(repeat, fn):
+    '''Return the shortest of repeat timings of fn(), in seconds.
+    '''
+    best = None
+    for i in range(repeat):
+        start = timer()
+        fn()
+        t = timer() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def bench_load(filename, repeat):
+    '''Time loading the map afresh, and again while a copy is loaded so
+    its tilesets are shared through the tileset registry.
+    '''
+    def load():
+        tmx.registry.clear()
+        tmx.load(filename, (640, 360))
+    result = dict(load_s=best_of(repeat, load))
+    # held so its tilesets stay registered while reloading
+    loaded = tmx.load(filename, (640, 360))
+    result['reload_s'] = best_of(repeat,
+        lambda: tmx.load(filename, (640, 360)))
+    return result
+
+
+def bench_frames(screen, filename, frames):
+    '''Time game update and draw per frame with the player running about.
+    '''
+    script = [(0, ['right', 'lshift']), (frames // 3, ['left', 'space']),
+        (2 * frames // 3, ['right', 'up', 'lshift'])]
+    game = platformer.Game(input=platformer.ScriptedInput(script),
+        level=filename)
+    game.load(screen)
+    dt = 1. / game.sim_hz
+    update = draw = 0.
+    done = 0
+    while done < frames and game.input.poll():
+        start = timer()
+        game.update(dt)
+        game.check_state()
+        update += timer() - start
+        start = timer()
+        game.draw()
+        draw += timer() - start
+        done += 1
+    return dict(frames=done, update_ms=1000 * update / done,
+        draw_ms=1000 * draw / done, sprites=len(game.sprites) +
+        len(game.enemies) + len(game.coins))
+
+
+def bench_sim_rates(screen, filename, seconds=10, rates=(25, 10, 5)):
+    '''Time game updates per simulated second with the player running
+    about at each of the simulation rates given.
+    '''
+    results = {}
+    for sim_hz in rates:
+        steps = int(seconds * sim_hz)
+        script = [(0, ['right', 'lshift']), (steps // 3, ['left', 'space']),
+            (2 * steps // 3, ['right', 'up', 'lshift'])]
+        game = platformer.Game(input=platformer.ScriptedInput(script),
+            level=filename, sim_hz=sim_hz)
+        game.load(screen)
+        dt = 1. / sim_hz
+        start = timer()
+        for i in range(steps):
+            game.input.poll()
+            game.update(dt)
+            game.check_state()
+        results['sim_%dhz_ms_per_s' % sim_hz] = 1000 * (timer() - start) / \
+            seconds
+    return results
+
+
+def bench_sprite_draw(screen, sprites=2000, repeat=20, seed=0):
+    '''Time drawing sprites with images from a cache with and without an
+    atlas, one blit call at a time and batched into one Surface.blits()
+    call, and through SpriteLayer.draw().
+    '''
+    rnd = random.Random(seed)
+    names = ['coin.png', 'bullet.png', 'enemy-bullet.png', 'enemy-left.png',
+        'enemy-right.png', 'player-left.png', 'player-right.png']
+    w, h = screen.get_size()
+    result = {}
+    for prefix, atlas in (('sprite', None), ('sprite_atlas', assets.Atlas())):
+        cache = assets.AssetCache(atlas=atlas)
+        layer = tmx.SpriteLayer()
+        for i in range(sprites):
+            sprite = pygame.sprite.Sprite()
+            sprite.image = cache.image(rnd.choice(names))
+            sprite.rect = sprite.image.get_rect(topleft=(rnd.randrange(w),
+                rnd.randrange(h)))
+            layer.add(sprite)
+        layer.set_view(0, 0, w, h)
+        blits = [(sprite.image, sprite.rect) for sprite in layer]
+        def single():
+            for image, rect in blits:
+                screen.blit(image, rect)
+        result[prefix + '_blit_ms'] = 1000 * best_of(repeat, single)
+        result[prefix + '_blits_ms'] = 1000 * best_of(repeat,
+            lambda: tmx.blit_all(screen, blits))
+        result[prefix + '_layer_draw_ms'] = 1000 * best_of(repeat,
+            lambda: layer.draw(screen))
+    return result
+
+
+def bench_assets(threads=4, repeat=5):
+    '''Time loading the game's images and sounds into an empty cache one
+    after another, and with AssetCache.preload() on a pool of threads.
+    '''
+    images = platformer.IMAGES + tmx.tileset_images('new-map.tmx')
+    def sequential():
+        cache = assets.AssetCache(atlas=assets.Atlas())
+        for filename in images:
+            cache.image(filename)
+        for filename in platformer.SOUNDS:
+            cache.sound(filename)
+    def parallel():
+        cache = assets.AssetCache(atlas=assets.Atlas())
+        cache.preload(images, platformer.SOUNDS, threads)
+    return dict(assets_sequential_ms=1000 * best_of(repeat, sequential),
+        assets_preload_ms=1000 * best_of(repeat, parallel),
+        assets_threads=threads)
+
+
+def bench_enemies(screen, filename, frames):
+    '''Time updating the map's enemies per frame, each Enemy on its own and
+    as an EnemySwarm (when NumPy is available) with every enemy awake, and
+    with only those near the view awake.
+    '''
+    results = {}
+    modes = [('enemy_update_ms', False, None)]
+    if platformer.numpy is not None:
+        modes.append(('enemy_swarm_update_ms', True, None))
+    modes.append(('enemy_nearby_update_ms', None, 320))
+    for label, swarm, margin in modes:
+        game = platformer.Game(input=platformer.ScriptedInput(),
+            level=filename, swarm=swarm, activity_margin=margin)
+        game.load(screen)
+        dt = 1. / game.sim_hz
+        # the first update builds the swarm's arrays
+        game.enemies.update(dt, game)
+        def run():
+            for i in range(frames):
+                game.enemies.update(dt, game)
+        results[label] = 1000 * best_of(1, run) / frames
+    return results
+
+
+def bench_bullets(screen, filename, bullets=500, steps=20, seed=0):
+    '''Time moving a volley of bullets scattered over the map per step,
+    each Bullet on its own and from a ProjectilePool (when NumPy is
+    available.)
+    '''
+    results = {}
+    modes = [('bullet_update_ms', False)]
+    if platformer.numpy is not None:
+        modes.append(('bullet_pool_update_ms', True))
+    for label, pool in modes:
+        game = platformer.Game(input=platformer.ScriptedInput(),
+            level=filename, pool=pool)
+        game.load(screen)
+        rnd = random.Random(seed)
+        for i in range(bullets):
+            game.fire(rnd.choice(('player', 'enemy')),
+                (rnd.randint(0, game.tilemap.px_width),
+                rnd.randint(0, game.tilemap.px_height)), rnd.choice((-1, 1)))
+        layer = game.projectiles or game.sprites
+        dt = 1. / game.sim_hz
+        def run():
+            for i in range(steps):
+                game.steps += 1
+                layer.update(dt, game)
+        results[label] = 1000 * best_of(1, run) / steps
+    return results
+
+
+def bench_queries(filename, queries, seed=0):
+    '''Time trigger layer queries for sprite-sized rects scattered over the
+    map, and the same lookups in a TriggerGrid of the layer, in microseconds
+    per query; and count the grid's lookups that don't agree with the layer
+    for rects scattered over and off the map.
+    '''
+    tilemap = tmx.load(filename, (640, 360))
+    triggers = tilemap.layers['triggers']
+    rnd = random.Random(seed)
+    rects = [pygame.Rect(rnd.randint(0, tilemap.px_width),
+        rnd.randint(0, tilemap.px_height), 16, 32) for i in range(queries)]
+    results = {}
+    for prop in ('blockers', 'action', 'reverse', 'exit'):
+        def run():
+            for rect in rects:
+                triggers.collide(rect, prop)
+        results['collide_%s_us' % prop] = 1e6 * best_of(3, run) / queries
+    def region():
+        for rect in rects:
+            triggers.get_in_region(rect.left, rect.top, rect.right,
+                rect.bottom)
+    results['get_in_region_us'] = 1e6 * best_of(3, region) / queries
+    def find():
+        for i in range(100):
+            triggers.find('enemy')
+    results['find_us'] = 1e6 * best_of(3, find) / 100
+    start = timer()
+    grid = platformer.TriggerGrid(triggers, tilemap.tile_width,
+        tilemap.tile_height)
+    results['trigger_grid_build_ms'] = 1000 * (timer() - start)
+    def cells():
+        for rect in rects:
+            grid.cells(rect)
+    results['trigger_grid_cells_us'] = 1e6 * best_of(3, cells) / queries
+    # rects anywhere from off the top left to off the bottom right of the
+    # map, the grid's answers checked against the layer's
+    rects = [pygame.Rect(rnd.randint(-64, tilemap.px_width + 64),
+        rnd.randint(-64, tilemap.px_height + 64), rnd.randint(1, 64),
+        rnd.randint(1, 64)) for i in range(queries)]
+    results['trigger_grid_mismatches'] = sum(
+        trigger_grid_mismatches(triggers, grid, rect) for rect in rects)
+    return results
+
+
+def trigger_grid_mismatches(triggers, grid, rect):
+    '''Count the lookups in the TriggerGrid for the rect that don't agree
+    with the triggers layer's collide().
+    '''
+    G = platformer.TriggerGrid
+    expected = {}
+    for t in triggers.collide(rect, 'blockers'):
+        for k, side in enumerate('lrtb'):
+            if side in t['blockers']:
+                expected[G.BLOCK_L << k] = True
+    expected[G.REVERSE] = bool(triggers.collide(rect, 'reverse'))
+    expected[G.EXIT] = bool(triggers.collide(rect, 'exit'))
+    ladders = [t for t in triggers.collide(rect, 'action')
+        if 'l' in t['action']]
+    expected[G.LADDER] = bool(ladders)
+    within = any(t.left <= rect.left and rect.right <= t.right
+        for t in ladders)
+
+    found = grid.cells(rect)
+    count = 0
+    for mask in (G.BLOCK_L, G.BLOCK_R, G.BLOCK_T, G.BLOCK_B, G.REVERSE,
+            G.EXIT, G.LADDER):
+        touches = grid.touches(rect, mask)
+        if touches != expected.get(mask, False):
+            count += 1
+        if touches != any(cell[4] & mask for cell in found):
+            count += 1
+    if grid.within(rect, G.LADDER, G.LADDER_L, G.LADDER_R) != within:
+        count += 1
+    return count
+
+
+# Cell and Object as they were laid out before being slotted: attributes in
+# an instance dict and property override containers created up front. Used
+# as the baseline for bench_instances().
+
+class DictCell(object):
+    def __init__(self, x, y, px, py, tile):
+        self.x, self.y = x, y
+        self.px, self.py = px, py
+        self.tile = tile
+        self.topleft = (px, py)
+        self.left = px
+        self.right = px + tile.tile_width
+        self.top = py
+        self.bottom = py + tile.tile_height
+        self.center = (px + tile.tile_width // 2, py + tile.tile_height // 2)
+        self._added_properties = {}
+        self._deleted_properties = set()
+        self._layer = None
+
+
+class DictObject(object):
+    def __init__(self, type, x, y, width=0, height=0, name=None,
+            gid=None, tile=None, visible=1):
+        self.type = type
+        self.px = x
+        self.left = x
+        self.py = y
+        self.top = y
+        self.width = width
+        self.right = x + width
+        self.height = height
+        self.bottom = y + height
+        self.name = name
+        self.gid = gid
+        self.tile = tile
+        self.visible = visible
+        self.properties = {}
+        self._added_properties = {}
+        self._deleted_properties = set()
+        self._layer = None
+
+
+def instance_bytes(obj):
+    '''Return the memory used by obj itself, its instance dict and its
+    property override containers and position tuples.
+    '''
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    for name in ('_added_properties', '_deleted_properties', 'topleft',
+            'center', 'properties'):
+        value = getattr(obj, name, None)
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+
+
+def bench_instances(filename, sample=20000):
+    '''Compare the per-instance memory and attribute access time of the
+    slotted Cell and Object against their dict-based equivalents, using up
+    to sample of the map's cells and all of its trigger objects.
+    '''
+    tilemap = tmx.load(filename, (640, 360), cache=False, compact=True)
+    grid = tilemap.layers['set'].cells
+    positions = [pos for pos, i in zip(grid, range(sample))]
+    cells = [grid[pos] for pos in positions]
+    legacy_cells = [DictCell(c.x, c.y, c.px, c.py, c.tile) for c in cells]
+    objects = tilemap.layers['triggers'].objects
+    legacy_objects = []
+    for o in objects:
+        d = DictObject(o.type, o.px, o.py, o.width, o.height, o.name, o.gid,
+            o.tile, o.visible)
+        d.properties = o.properties
+        legacy_objects.append(d)
+
+    def access(items):
+        def run():
+            for item in items:
+                item.left + item.right + item.top + item.bottom
+        return 1e9 * best_of(5, run) / len(items)
+
+    result = dict(instances_sampled=len(cells))
+    for label, slotted, legacy in (('cell', cells, legacy_cells),
+            ('object', objects, legacy_objects)):
+        result['%s_bytes' % label] = sum(map(instance_bytes, slotted)) / \
+            float(len(slotted))
+        result['%s_dict_bytes' % label] = sum(map(instance_bytes, legacy)) / \
+            float(len(legacy))
+        result['%s_access_ns' % label] = access(slotted)
+        result['%s_dict_access_ns' % label] = access(legacy)
+    return result
+
+
+def bench_stream(filename, steps=50):
+    '''Time loading the map streamed, against loading it whole, and moving
+    the view across it diagonally in steps, and report how many regions were
+    read and evicted and how much decompressed cell data stayed resident.
+    '''
+    start = timer()
+    tmx.load(filename, (640, 360), cache=False)
+    whole = timer() - start
+    start = timer()
+    tilemap = tmx.load(filename, (640, 360), cache=False, stream=True)
+    load = timer() - start
+    grid = tilemap.layers['set'].cells
+    result = dict(stream_load_s=load, stream_whole_load_s=whole,
+        stream_compressed_bytes=len(grid.source.data))
+    start = timer()
+    for i in range(steps):
+        tilemap.set_focus(tilemap.px_width * i // steps,
+            tilemap.px_height * i // steps)
+    result.update(stream_focus_ms=1000 * (timer() - start) / steps,
+        stream_resident_bytes=grid.resident_bytes,
+        stream_loads=grid.loads, stream_evictions=grid.evictions)
+    return result
+
+
+def encode_layer(gids, encoding, compression):
+    '''Return the text of a TMX <data> element holding gids.
+    '''
+    if encoding == 'csv':
+        return ','.join(str(gid) for gid in gids)
+    data = struct.pack('<%di' % len(gids), *gids)
+    if compression == 'zlib':
+        data = zlib.compress(data)
+    elif compression == 'gzip':
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write(data)
+        data = out.getvalue()
+    elif compression == 'zstd':
+        data = tmx.zstandard.ZstdCompressor().compress(data)
+    return base64.b64encode(data).decode('ascii')
+
+
+def bench_decode(filename, repeat=5):
+    '''Time decoding the map's tile layer in each encoding, and in
+    base64/zlib the old way, unpacking a tuple of ints with struct.
+    '''
+    tilemap = tmx.load(filename, (640, 360), cache=False)
+    gids = list(tilemap.layers['set'].gids())
+    formats = [('csv', None), ('base64', None), ('base64', 'gzip'),
+        ('base64', 'zlib')]
+    if tmx.zstandard is not None:
+        formats.append(('base64', 'zstd'))
+    result = {}
+    for encoding, compression in formats:
+        text = encode_layer(gids, encoding, compression)
+        result['decode_%s_ms' % (compression or encoding)] = 1000 * best_of(
+            repeat, lambda: tmx.decode_data(text, encoding, compression))
+    text = encode_layer(gids, 'base64', 'zlib')
+    def legacy():
+        data = zlib.decompress(base64.b64decode(text))
+        struct.unpack('<%di' % (len(data) // 4), data)
+    result['decode_struct_ms'] = 1000 * best_of(repeat, legacy)
+    return result
+
+
+def run(scales, frames=200, queries=2000, repeat=3, directory=None):
+    '''Run the benchmarks at each of the scales, writing the generated maps
+    to directory (by default a temporary directory, removed afterwards), and
+    return the results. Must be run from the game's directory (HERE).
+    '''
+    if directory is not None:
+        return _run(scales, frames, queries, repeat, directory)
+    directory = tempfile.mkdtemp(prefix='platformer-bench-')
+    try:
+        return _run(scales, frames, queries, repeat, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _run(scales, frames, queries, repeat, directory):
+    screen = platformer.headless_screen()
+    results = []
+    for width, height, triggers, enemies, coins in scales:
+        filename = os.path.join(directory, 'bench-%dx%d-%d-%d-%d.tmx' % (width,
+            height, triggers, enemies, coins))
+        generate_map(filename, width, height, triggers, enemies, coins)
+        result = dict(width=width, height=height, triggers=triggers,
+            enemies=enemies, coins=coins,
+            map_bytes=os.path.getsize(filename))
+        result.update(bench_load(filename, repeat))
+        result.update(bench_frames(screen, filename, frames))
+        result.update(bench_sim_rates(screen, filename))
+        result.update(bench_enemies(screen, filename, frames))
+        result.update(bench_bullets(screen, filename))
+        result.update(bench_queries(filename, queries))
+        result.update(bench_instances(filename))
+        result.update(bench_stream(filename))
+        result.update(bench_decode(filename))
+        results.append(result)
+        sys.stderr.write('%(width)dx%(height)d: load %(load_s).3fs, update '
+            '%(update_ms).2fms, draw %(draw_ms).2fms, enemies '
+            '%(enemy_update_ms).2fms, collide '
+            '%(collide_blockers_us).1fus, cell %(cell_bytes)d bytes (was '
+            '%(cell_dict_bytes)d)\n' % result)
+    return dict(python=platform.python_version(),
+        pygame=pygame.version.ver, platform=platform.platform(),
+        frames=frames, queries=queries, results=results,
+        sprites=bench_sprite_draw(screen), assets=bench_assets())
+
+
+def parse_scale(text):
+    # WxH:triggers:enemies:coins
+    size, triggers, enemies, coins = text.split(':')
+    width, height = size.split('x')
+    return int(width), int(height), int(triggers), int(enemies), int(coins)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', action='append', type=parse_scale,
+        metavar='WxH:T:E:C', help='map size in tiles and trigger, enemy and '
+        'coin counts; may be repeated')
+    parser.add_argument('--frames', type=int, default=200,
+        help='frames to update and draw per scale')
+    parser.add_argument('--queries', type=int, default=2000,
+        help='collide queries per scale')
+    parser.add_argument('--output', metavar='FILE',
+        help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    # the output is relative to where we were run from, the maps to HERE
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    os.chdir(HERE)
+    results = run(args.scale or DEFAULT_SCALES, args.frames, args.queries)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write('\n')
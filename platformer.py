@@ -19,29 +19,52 @@
 # Created: 29/10/13
 
 import os
+import json
+import array
+import time
+import argparse
+from collections import deque
 import pygame
 import tmx
+import assets
+import profiler
 from pygame import joystick
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the images and sounds used in playing a level, which are loaded together
+# (along with the level's tileset images) when it starts
+IMAGES = ['background.png', 'gameover.png', 'youwin.png', 'healthbar.png',
+    'health.png', 'player-left.png', 'player-right.png', 'enemy-left.png',
+    'enemy-right.png', 'bullet.png', 'enemy-bullet.png', 'coin.png',
+    'explosion-sprite.png']
+SOUNDS = ['jump.wav', 'shoot.wav', 'explosion.wav']
+
 
 def load_sliced_sprites(self, w, h, filename):
     # Master can be any height. Frames must be the same width. Master width will be len(frames)*frame.width
-    images = []
-    master_image = pygame.image.load(os.path.join('', filename)).convert_alpha()
-
-    # use pygame subsurface for splitting into frames from one image.
-    master_width, master_height = master_image.get_size()
-    for i in xrange(int(master_width/w)):
-        images.append(master_image.subsurface((i*w,0,w,h)))
-    return images
+    # The frames are pygame subsurfaces of the one shared master image held
+    # by the asset cache.
+    return list(assets.sliced(os.path.join('', filename), w, h))
 
 
 class Explosion(pygame.sprite.Sprite):
+    # there can be many of these short-lived sprites about so keep their
+    # attributes in slots rather than an instance dict
+    __slots__ = ('_images', 'lifespan', 'born', '_start', '_delay',
+        '_last_update', '_frame', 'image', 'rect')
+
     def __init__(self, images, location, fps = 10, *groups):
         super(Explosion, self).__init__(*groups)
         self._images = images
         # time this explosion will live for in seconds
         self.lifespan = 0.5
+        # the game step the explosion appeared in, if it was made by a layer
+        # updated before its own and so mustn't be updated until the next one
+        self.born = None
 
         # Track the time we started, and the time between updates.
         # Then we can figure out when we have to switch the image.
@@ -62,6 +85,8 @@ class Explosion(pygame.sprite.Sprite):
         self.rect = pygame.rect.Rect((x, y), (w, h))
 
     def update(self, dt, game):
+        if self.born == game.steps:
+            return
         # decrement the lifespan of the explosion by the amount of time passed and
         # remove it from the game if its time runs out
         self.lifespan -= dt
@@ -79,17 +104,32 @@ class Explosion(pygame.sprite.Sprite):
 
 
 class Collectable(pygame.sprite.Sprite):
+    __slots__ = ('image', 'rect')
+
     def __init__(self, location, *groups):
         super(Collectable, self).__init__(*groups)
-        self.image = pygame.image.load('coin.png')
+        self.image = assets.image('coin.png')
         self.rect = pygame.rect.Rect(location, self.image.get_size())
 
     def update(self, dt, game):
         if self.rect.colliderect(game.player.rect):
-            game.score = game.score + 10
-            if game.health < 200:
-                game.health = game.health + 5
-            self.kill()
+            self.collect(game)
+
+    def collect(self, game):
+        game.score = game.score + 10
+        if game.health < 200:
+            game.health = game.health + 5
+        self.kill()
+
+
+#
+# Rather than every coin checking whether the player has touched it each
+# update, a coin layer looks up just the coins under the player.
+#
+class CoinLayer(tmx.SpriteLayer):
+    def update(self, dt, game):
+        for coin in self.collide(game.player.rect):
+            coin.collect(game)
 
 #
 # Our enemies just move from side to side between "reverse" map triggers.
@@ -97,11 +137,14 @@ class Collectable(pygame.sprite.Sprite):
 #
 class Enemy(pygame.sprite.Sprite):
     #image = pygame.image.load('enemy.png')
+    __slots__ = ('image', 'right_image', 'left_image', 'rect', 'direction',
+        'gun_cooldown')
+
     def __init__(self, location, *groups):
         super(Enemy, self).__init__(*groups)
-        self.image = pygame.image.load('enemy-right.png')
+        self.image = assets.image('enemy-right.png')
         self.right_image = self.image
-        self.left_image = pygame.image.load('enemy-left.png')
+        self.left_image = assets.image('enemy-left.png')
         self.rect = pygame.rect.Rect(location, self.image.get_size())
         # movement in the X direction; postive is right, negative is left
         self.direction = 1
@@ -112,16 +155,20 @@ class Enemy(pygame.sprite.Sprite):
         # move the enemy by 100 pixels per second in the movement direction
         self.rect.x += self.direction * 100 * dt
 
-        # check all reverse triggers in the map to see whether this enemy has
-        # touched one
-        for cell in game.tilemap.layers['triggers'].collide(self.rect, 'reverse'):
+        # check the trigger grid to see whether this enemy has touched a
+        # reverse trigger
+        grid = game.trigger_grid
+        for x, y, x2, y2, bits in grid.cells(self.rect):
+            if not bits & grid.REVERSE:
+                continue
+            left, right = grid.span(x, y, grid.REVERSE_L, grid.REVERSE_R)
             # reverse movement direction; make sure to move the enemy out of the 
             # collision so it doesn't collide again immediately next update
             if self.direction > 0:
-                self.rect.right = cell.left
+                self.rect.right = left
                 self.image = self.left_image
             else:
-                self.rect.left = cell.right
+                self.rect.left = right
                 self.image = self.right_image
             self.direction *= -1
             break
@@ -134,12 +181,12 @@ class Enemy(pygame.sprite.Sprite):
 
         if (game.player.rect.x < self.rect.x) and not self.gun_cooldown:
             if ((self.rect.x - game.player.rect.x) < 200) and (self.direction == -1) and (player_distance <= 32):
-                Bullet('enemy', self.rect.midleft, -1, game.sprites)
+                game.fire('enemy', self.rect.midleft, -1)
                 self.gun_cooldown = 1
                 game.shoot.play()
         elif not self.gun_cooldown:
             if ((game.player.rect.x - self.rect.x) < 200) and (self.direction == 1) and (player_distance <= 32):
-                Bullet('enemy', self.rect.midright, 1, game.sprites)
+                game.fire('enemy', self.rect.midright, 1)
                 self.gun_cooldown = 1
                 game.shoot.play()
 
@@ -161,18 +208,478 @@ class Enemy(pygame.sprite.Sprite):
                 self.rect.x = self.rect.x + 16
             self.direction *= -1
 
+def trigger_bounds(tilemap, propname):
+    # find every trigger with the property in the order collide() would
+    # return them, and their left, right, top and bottom edges as arrays
+    found = tilemap.layers['triggers'].collide(pygame.Rect(tilemap.px_left,
+        tilemap.px_top, tilemap.px_width, tilemap.px_height), propname)
+    return (found, numpy.array([t.left for t in found], int),
+        numpy.array([t.right for t in found], int),
+        numpy.array([t.top for t in found], int),
+        numpy.array([t.bottom for t in found], int))
+
+
+#
+# A trigger grid is the map's "triggers" layer rasterized into a grid of
+# bitmasks, worked out once when a level is loaded, so the player, bullets
+# and enemies look up the few cells they touch rather than querying the
+# triggers layer and checking property strings every update.
+#
+# Cells are tile sized. Each cell has bits set for the sides blocked by the
+# blockers covering it, for the blocked sides of those blockers that run
+# along its edges, and likewise for ladders, "reverse" triggers and exits.
+# Triggers not lined up with the tiles only partly cover some cells, and
+# overlapping triggers share some; those cells also keep the rects and bits
+# of every trigger over them, and are looked up piece by piece. The grid doesn't follow changes to the triggers
+# layer; build a new one.
+#
+class TriggerGrid(object):
+    # on every cell of a blocker blocking its left, right, top or bottom side
+    BLOCK_L, BLOCK_R, BLOCK_T, BLOCK_B = 0x1, 0x2, 0x4, 0x8
+    # on the cells along that side of such a blocker
+    EDGE_L, EDGE_R, EDGE_T, EDGE_B = 0x10, 0x20, 0x40, 0x80
+    # on every cell of a ladder, and on those along its left, right and top
+    LADDER, LADDER_L, LADDER_R, LADDER_T = 0x100, 0x200, 0x400, 0x800
+    # on every cell of a "reverse" trigger, and on those along its sides
+    REVERSE, REVERSE_L, REVERSE_R = 0x1000, 0x2000, 0x4000
+    EXIT = 0x8000
+
+    def __init__(self, triggers, tile_width, tile_height):
+        # each trigger with the bits for all its cells and for the cells along
+        # its left, right, top and bottom sides
+        marks = []
+        for t in triggers.find('blockers'):
+            sides = t['blockers']
+            bits = [0, 0, 0, 0, 0]
+            for k, side in enumerate('lrtb'):
+                if side in sides:
+                    bits[0] |= self.BLOCK_L << k
+                    bits[k + 1] |= self.EDGE_L << k
+            marks.append((t, bits))
+        for t in triggers.find('action'):
+            if 'l' in t['action']:
+                marks.append((t, [self.LADDER, self.LADDER_L, self.LADDER_R,
+                    self.LADDER_T, 0]))
+        for t in triggers.find('reverse'):
+            marks.append((t, [self.REVERSE, self.REVERSE_L, self.REVERSE_R,
+                0, 0]))
+        for t in triggers.find('exit'):
+            marks.append((t, [self.EXIT, 0, 0, 0, 0]))
+        marks = [(t, bits) for t, bits in marks if t.width and t.height]
+
+        cw, ch = self.cell_width, self.cell_height = tile_width, tile_height
+        if marks:
+            self.x = min(t.left for t, bits in marks) // cw * cw
+            self.y = min(t.top for t, bits in marks) // ch * ch
+        else:
+            self.x = self.y = 0
+        self.columns = max([(t.right - self.x + cw - 1) // cw
+            for t, bits in marks] or [0])
+        self.rows = max([(t.bottom - self.y + ch - 1) // ch
+            for t, bits in marks] or [0])
+
+        self.bits = array.array('H', [0]) * (self.columns * self.rows)
+        # the (trigger, bits) of every trigger over each cell that is partly
+        # covered or under more than one trigger (where the sides of one
+        # could be taken for those of another), keyed off the cell's offset
+        # into bits
+        self.pieces = {}
+        over = {}
+        for t, bits in marks:
+            for i, b, whole in self._marked(t, bits):
+                self.bits[i] |= b
+                over.setdefault(i, []).append((t, b))
+                if not whole:
+                    self.pieces[i] = over[i]
+        for i, found in over.items():
+            if len(found) > 1:
+                self.pieces[i] = found
+
+    def _marked(self, t, marks):
+        # the offset into bits of each cell trigger t overlaps, the bits it
+        # sets there and whether it covers the whole cell
+        cover, left, right, top, bottom = marks
+        cw, ch = self.cell_width, self.cell_height
+        i1, i2 = (t.left - self.x) // cw, (t.right - 1 - self.x) // cw
+        j1, j2 = (t.top - self.y) // ch, (t.bottom - 1 - self.y) // ch
+        for j in range(j1, j2 + 1):
+            cy = self.y + j * ch
+            edges = cover
+            if j == j1:
+                edges |= top
+            if j == j2:
+                edges |= bottom
+            tall = t.top <= cy and t.bottom >= cy + ch
+            for i in range(i1, i2 + 1):
+                cx = self.x + i * cw
+                b = edges
+                if i == i1:
+                    b |= left
+                if i == i2:
+                    b |= right
+                yield (j * self.columns + i, b, tall and t.left <= cx and
+                    t.right >= cx + cw)
+
+    def _rows(self, rect):
+        # the first and last column and the rows (as offsets into bits) of
+        # the cells the rect overlaps or touches; no rows if it lies clear of
+        # the grid
+        cw, ch = self.cell_width, self.cell_height
+        i1 = max(0, (rect.left - 1 - self.x) // cw)
+        i2 = min(self.columns - 1, (rect.right - self.x) // cw)
+        j1 = max(0, (rect.top - 1 - self.y) // ch)
+        j2 = min(self.rows - 1, (rect.bottom - self.y) // ch)
+        if i1 > i2 or j1 > j2:
+            return 0, -1, range(0)
+        return i1, i2, range(j1 * self.columns, (j2 + 1) * self.columns,
+            self.columns)
+
+    def _pieces(self, i, rect):
+        # the (left, top, right, bottom, bits) of the parts of the triggers
+        # over partly covered cell i that the rect overlaps or touches
+        cx = self.x + i % self.columns * self.cell_width
+        cy = self.y + i // self.columns * self.cell_height
+        found = []
+        for t, b in self.pieces[i]:
+            left, right = max(t.left, cx), min(t.right, cx + self.cell_width)
+            top = max(t.top, cy)
+            bottom = min(t.bottom, cy + self.cell_height)
+            if (left <= rect.right and right >= rect.left and
+                    top <= rect.bottom and bottom >= rect.top):
+                found.append((left, top, right, bottom, b))
+        return found
+
+    def cells(self, rect):
+        '''Return the (left, top, right, bottom, bits) of each cell with bits
+        set that the rect overlaps or touches, row by row. A partly covered
+        cell gives the part of each trigger over it the rect overlaps or
+        touches instead.
+        '''
+        cw, ch, cols = self.cell_width, self.cell_height, self.columns
+        i1, i2, rows = self._rows(rect)
+        found = []
+        bits = self.bits
+        pieces = self.pieces
+        for row in rows:
+            strip = bits[row + i1:row + i2 + 1]
+            if not any(strip):
+                continue
+            top = self.y + row // cols * ch
+            for i, b in enumerate(strip, i1):
+                if not b:
+                    continue
+                if row + i in pieces:
+                    found.extend(self._pieces(row + i, rect))
+                else:
+                    left = self.x + i * cw
+                    found.append((left, top, left + cw, top + ch, b))
+        return found
+
+    def swept(self, last, new):
+        '''Return the cells with bits set, as lists of (left, top, right,
+        bottom, bits) row by row, that a rect moving from last to new passes
+        through or touches at new: first those met moving across, then those
+        met moving up or down (see swept_rects().)
+        '''
+        across, down = swept_rects(last, new)
+        return self.cells(across), self.cells(down)
+
+    def touches(self, rect, mask):
+        '''Determine whether the rect overlaps or touches a cell (or the part
+        of a partly covered cell under a trigger) with any of the bits in
+        mask set.
+        '''
+        i1, i2, rows = self._rows(rect)
+        bits = self.bits
+        pieces = self.pieces
+        for row in rows:
+            for i, b in enumerate(bits[row + i1:row + i2 + 1], row + i1):
+                if b & mask:
+                    if i not in pieces:
+                        return True
+                    for piece in self._pieces(i, rect):
+                        if piece[4] & mask:
+                            return True
+        return False
+
+    def span(self, x, y, left, right):
+        '''Return the left and right pixel edges of the run of cells around
+        the cell at (x, y) bounded by cells with the left and right bits.
+        '''
+        cw = self.cell_width
+        i = min(max(0, (x - self.x) // cw), self.columns - 1)
+        row = (y - self.y) // self.cell_height * self.columns
+        bits = self.bits
+        i1 = i2 = i
+        while i1 > 0 and not bits[row + i1] & left:
+            i1 -= 1
+        while i2 < self.columns - 1 and not bits[row + i2] & right:
+            i2 += 1
+        x1, x2 = self.x + i1 * cw, self.x + (i2 + 1) * cw
+        for t, b in self.pieces.get(row + i1, ()):
+            if b & left:
+                x1 = t.left
+        for t, b in self.pieces.get(row + i2, ()):
+            if b & right:
+                x2 = t.right
+        return x1, x2
+
+    def within(self, rect, cover, left, right):
+        '''Determine whether the rect touches a row of cells in which it lies
+        between the sides of a single run of cells with the cover bit,
+        bounded by cells with the left and right bits; or, where the cells
+        are partly covered, between the sides of a trigger with the cover
+        bit.
+        '''
+        cw, ch = self.cell_width, self.cell_height
+        i1 = (rect.left - self.x) // cw
+        i2 = (rect.right - 1 - self.x) // cw
+        if i1 < 0 or i2 >= self.columns or i2 < i1:
+            return False
+        bits = self.bits
+        pieces = self.pieces
+        for j in range(max(0, (rect.top - 1 - self.y) // ch),
+                min(self.rows - 1, (rect.bottom - self.y) // ch) + 1):
+            row = j * self.columns
+            for i in range(i1, i2 + 1):
+                if row + i in pieces:
+                    for t, b in pieces[row + i]:
+                        if (b & cover and t.left <= rect.left and
+                                rect.right <= t.right and
+                                t.top <= rect.bottom and
+                                t.bottom >= rect.top):
+                            return True
+                    break
+                b = bits[row + i]
+                if not b & cover or (i > i1 and b & left) or \
+                        (i < i2 and b & right):
+                    break
+            else:
+                return True
+        return False
+
+def swept_rects(last, new):
+    # the rects a rect moving from last to new sweeps across and sweeps up or
+    # down; the rect is swept along each axis separately, the first rect
+    # spanning the rows it covers at last and at new (and between them, so
+    # nothing a diagonal move passes is missed; see in_rows_at() for which of
+    # them it actually meets) from its last to new left and right sides and
+    # the second spanning the columns it covers at new from its last to new
+    # top and bottom. Neither includes the sides moved away from, so a rect
+    # moving less than a cell in an update meets just what the rect at new
+    # touches, while one moving further meets every cell it passes.
+    left, right = min(last.left, new.left), max(last.right, new.right)
+    if new.left > last.left:
+        left += 1
+    elif new.left < last.left:
+        right -= 1
+    top, bottom = min(last.top, new.top), max(last.bottom, new.bottom)
+    if new.top > last.top:
+        top += 1
+    elif new.top < last.top:
+        bottom -= 1
+    return (pygame.Rect(left, top, right - left, bottom - top),
+        pygame.Rect(new.left, top, new.width, bottom - top))
+
+def in_rows_at(last, dx, dy, distance, top, bottom):
+    # whether a rect moving from last by (dx, dy) overlaps or touches the
+    # rows from top to bottom by the time it has moved distance of the way
+    # across (taken in integers, scaled by dx, so the result is exact)
+    if dx < 0:
+        dx, distance = -dx, -distance
+    return (last.top * dx + dy * distance <= bottom * dx and
+        last.bottom * dx + dy * distance >= top * dx)
+
+
+#
+# An enemy swarm is a sprite layer of Enemies which updates them all at once
+# with NumPy array operations rather than calling each Enemy's update(). The
+# enemies' positions, directions and gun cooldowns are kept in arrays (one
+# entry per enemy) and copied back to the Enemy sprites, which are still what
+# is drawn and collided with, so the game sees exactly what Enemy.update()
+# would have done.
+#
+# Enemies only patrol left and right, so the "reverse" triggers each one can
+# ever touch are worked out once whenever enemies are added or removed. An
+# enemy moved vertically from outside the swarm needs a call to rebuild().
+#
+# Without NumPy the swarm just updates each Enemy in turn.
+#
+class EnemySwarm(tmx.SpriteLayer):
+    def __init__(self):
+        super(EnemySwarm, self).__init__()
+        # the enemies in array order, and whether that needs rebuilding
+        self._members = []
+        self._changed = True
+        # the triggers layer the "reverse" trigger arrays were taken from
+        self._triggers = None
+
+    def add_internal(self, sprite, *args):
+        super(EnemySwarm, self).add_internal(sprite, *args)
+        self._changed = True
+
+    def remove_internal(self, sprite, *args):
+        super(EnemySwarm, self).remove_internal(sprite, *args)
+        self._changed = True
+
+    def rebuild(self, tilemap=None):
+        '''Reload the arrays from the Enemy sprites (and, if a tilemap is
+        given, the "reverse" triggers from its triggers layer.)
+        '''
+        if tilemap is not None:
+            self._load_triggers(tilemap)
+        self._changed = True
+
+    def _load_triggers(self, tilemap):
+        found, self._left, self._right, self._top, self._bottom = \
+            trigger_bounds(tilemap, 'reverse')
+        self._triggers = tilemap.layers['triggers']
+        self._changed = True
+
+    def _load(self):
+        members = self._members = self.sprites()
+        self._index = dict((sprite, i) for i, sprite in enumerate(members))
+        rects = [sprite.rect for sprite in members]
+        self._x = numpy.array([r.x for r in rects], int)
+        self._y = numpy.array([r.y for r in rects], int)
+        self._w = numpy.array([r.width for r in rects], int)
+        self._h = numpy.array([r.height for r in rects], int)
+        self._direction = numpy.array([s.direction for s in members], int)
+        self._cooldown = numpy.array([s.gun_cooldown for s in members], float)
+
+        # pair each enemy with every trigger in its row, ordered by enemy and
+        # then trigger, so the first pair hit is the trigger Enemy.update()
+        # would have reversed on
+        enemies, triggers = [], []
+        rows = {}
+        for i, row in enumerate(zip(self._y.tolist(), self._h.tolist())):
+            rows.setdefault(row, []).append(i)
+        for (y, h), indexes in rows.items():
+            found = numpy.flatnonzero((self._top <= y + h) &
+                (self._bottom >= y))
+            enemies.append(numpy.repeat(indexes, len(found)))
+            triggers.append(numpy.tile(found, len(indexes)))
+        if enemies:
+            enemies = numpy.concatenate(enemies)
+            triggers = numpy.concatenate(triggers)
+        else:
+            enemies = triggers = numpy.zeros(0, int)
+        order = numpy.argsort(enemies, kind='mergesort')
+        self._pair_enemy = enemies[order].astype(int)
+        self._pair_trigger = triggers[order].astype(int)
+        # where each enemy's pairs start and end
+        indexes = numpy.arange(len(members))
+        self._pair_start = numpy.searchsorted(self._pair_enemy, indexes)
+        self._pair_end = numpy.searchsorted(self._pair_enemy, indexes,
+            'right')
+        self._changed = False
+
+    def update(self, dt, game):
+        if numpy is None:
+            super(EnemySwarm, self).update(dt, game)
+            return
+        if self._triggers is not game.tilemap.layers['triggers']:
+            self._load_triggers(game.tilemap)
+        if self._changed:
+            self._load()
+        members = self._members
+        if not members:
+            return
+        x, y, w, h = self._x, self._y, self._w, self._h
+        direction, cooldown = self._direction, self._cooldown
+
+        # only the enemies in the activity region are updated
+        if self.activity_margin is None:
+            awake = numpy.ones(len(members), bool)
+        else:
+            awake = numpy.zeros(len(members), bool)
+            index = self._index
+            awake[[index[sprite] for sprite in self.active()]] = True
+        active = numpy.flatnonzero(awake)
+
+        # move each enemy by 100 pixels per second in its movement direction,
+        # truncating as assigning to a Rect does
+        x[active] = (x[active] + direction[active] * 100 * dt).astype(int)
+
+        # reverse the enemies which touched a reverse trigger, moving them
+        # out of the trigger
+        enemies, triggers = self._pair_enemy, self._pair_trigger
+        if len(active) < len(members):
+            # just the pairs of the awake enemies
+            start = self._pair_start[active]
+            counts = self._pair_end[active] - start
+            pairs = numpy.repeat(start - numpy.cumsum(counts) + counts,
+                counts) + numpy.arange(counts.sum())
+            enemies, triggers = enemies[pairs], triggers[pairs]
+        hit = (self._left[triggers] <= (x + w)[enemies]) & \
+            (self._right[triggers] >= x[enemies])
+        enemies, first = numpy.unique(enemies[hit], return_index=True)
+        triggers = triggers[hit][first]
+        x[enemies] = numpy.where(direction[enemies] > 0,
+            self._left[triggers] - w[enemies], self._right[triggers])
+        direction[enemies] *= -1
+        turned = set(enemies.tolist())
+
+        # shoot at the player if they're within 200 pixels in the direction
+        # the enemy is facing and no more than 32 pixels above or below
+        player = game.player.rect
+        px, py = player.x, player.y
+        ready = awake & (cooldown == 0) & (abs(py - y) <= 32)
+        left = ready & (px < x) & (x - px < 200) & (direction == -1)
+        right = ready & (px >= x) & (px - x < 200) & (direction == 1)
+        last = cooldown.copy()
+        for i in numpy.flatnonzero(left | right).tolist():
+            if left[i]:
+                game.fire('enemy', (int(x[i]), int(y[i] + h[i] // 2)), -1)
+            else:
+                game.fire('enemy', (int(x[i] + w[i]), int(y[i] + h[i] // 2)),
+                    1)
+            cooldown[i] = 1
+            game.shoot.play()
+        cooldown[active] = numpy.maximum(0, cooldown[active] - dt)
+
+        # enemies touching the player hurt them and turn around
+        touching = numpy.flatnonzero(awake & (x < px + player.width) &
+            (x + w > px) & (y < py + player.height) & (y + h > py))
+        for i in touching.tolist():
+            game.health = game.health - 10
+            if direction[i] > 0:
+                x[i] -= 16
+            else:
+                x[i] += 16
+            direction[i] *= -1
+            turned.add(i)
+
+        # copy the results back to the sprites
+        moved = self.grid.move
+        for i, value in zip(active.tolist(), x[active].tolist()):
+            sprite = members[i]
+            sprite.rect.x = value
+            moved(sprite)
+        for i in numpy.flatnonzero(cooldown != last).tolist():
+            members[i].gun_cooldown = float(cooldown[i])
+        for i in turned:
+            sprite = members[i]
+            sprite.direction = int(direction[i])
+            if sprite.direction > 0:
+                sprite.image = sprite.right_image
+            else:
+                sprite.image = sprite.left_image
+
 #
 # Bullets fired by the player move in one direction until their lifespan runs
 # out or they hit an enemy. This has been extended to allow for enemy bullets.
 #
 class Bullet(pygame.sprite.Sprite):
+    __slots__ = ('image', 'rect', 'direction', 'lifespan', 'origin')
+
     def __init__(self, origin, location, direction, *groups):
         super(Bullet, self).__init__(*groups)
         # lets change the projectile depending on who fired.
         if origin == 'player':
-            self.image = pygame.image.load('bullet.png')
+            self.image = assets.image('bullet.png')
         else:
-            self.image = pygame.image.load('enemy-bullet.png')
+            self.image = assets.image('enemy-bullet.png')
         self.rect = pygame.rect.Rect(location, self.image.get_size())
         # movement in the X direction; postive is right, negative is left;
         # inherited from the origin (player / enemy)
@@ -200,7 +707,7 @@ class Bullet(pygame.sprite.Sprite):
         # if collided" flag as True so any collided enemies are removed from the
         # game
         if self.origin == 'player':
-            impact = pygame.sprite.spritecollide(self, game.enemies, True)
+            impact = game.enemies.spritecollide(self, True)
             if impact:
                 Explosion(game.explosion_images, impact[0].rect.center, 10, game.sprites)
                 game.explosion.play()
@@ -219,29 +726,186 @@ class Bullet(pygame.sprite.Sprite):
 
         # Check for wall collisions so we can't fire through.
         new = self.rect
-        # look up the tilemap triggers layer for all cells marked "blockers"
-        for cell in game.tilemap.layers['triggers'].collide(new, 'blockers'):
-            # find the actual value of the blockers property
-            blockers = cell['blockers']
-            # now for each side set in the blocker check for collision; only
-            # collide if we transition through the blocker side 
-            # and also check if we originate in the blocker (to avoid
-            # false-positives) and remove the bullet from the game
-            if 'l' in blockers and new.left <= cell.right:
-                game.explosion.play()
-                self.kill()
-                
-            if 'r' in blockers and new.right >= cell.left:
-                game.explosion.play()
-                self.kill()
+        # look up the trigger grid cells the bullet passes on the way from its
+        # last position (bullets fly level, so moving across is all there is)
+        # or touches at its new one, so it can't pass through a blocker
+        # however far it moves in an update; touching any blocker blocking
+        # from the left or right removes the bullet from the game
+        grid = game.trigger_grid
+        if grid.touches(swept_rects(last, new)[0],
+                grid.BLOCK_L | grid.BLOCK_R):
+            game.explosion.play()
+            self.kill()
 
-            if 'l' in blockers and last.right <= cell.left and new.right > cell.left:
-                game.explosion.play()
-                self.kill()
+#
+# A projectile pool is a sprite layer that moves every bullet in flight at
+# once with NumPy array operations. It keeps a preallocated set of Bullet
+# sprites along with their positions, directions, lifespans and owners in
+# arrays; firing takes a free Bullet from the pool rather than creating one
+# and bullets that expire or hit something are put back. Hits on enemies,
+# the player and "blockers" triggers are resolved for all the bullets
+# together, with the same results as Bullet.update().
+#
+# Bullets only fly left and right, so the blockers each one could hit are
+# found when it is fired.
+#
+class ProjectilePool(tmx.SpriteLayer):
+    def __init__(self, capacity=64):
+        super(ProjectilePool, self).__init__()
+        self._bullets = []
+        self._free = deque()
+        self._x = numpy.zeros(0, int)
+        self._y = numpy.zeros(0, int)
+        self._w = numpy.zeros(0, int)
+        self._h = numpy.zeros(0, int)
+        self._direction = numpy.zeros(0, int)
+        self._lifespan = numpy.zeros(0, float)
+        self._player = numpy.zeros(0, bool)
+        self._active = numpy.zeros(0, bool)
+        # the game step each bullet was fired in; bullets first move in the
+        # step after they're fired
+        self._fired = numpy.zeros(0, int)
+        # the blockers triggers layer and the triggers each bullet could hit
+        self._triggers = None
+        self._candidates = []
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        # add free bullets to the pool until it holds capacity of them
+        start = len(self._bullets)
+        extra = capacity - start
+        for name in ('_x', '_y', '_w', '_h', '_direction', '_lifespan',
+                '_player', '_active', '_fired'):
+            array = getattr(self, name)
+            setattr(self, name, numpy.concatenate((array,
+                numpy.zeros(extra, array.dtype))))
+        for i in range(start, capacity):
+            self._bullets.append(Bullet('player', (0, 0), 1))
+            self._candidates.append(None)
+            self._free.append(i)
+
+    def _load_triggers(self, tilemap):
+        found, self._left, self._right, self._top, self._bottom = \
+            trigger_bounds(tilemap, 'blockers')
+        values = [t['blockers'] for t in found]
+        self._blocks_left = numpy.array(['l' in v for v in values], bool)
+        self._blocks_right = numpy.array(['r' in v for v in values], bool)
+        self._triggers = tilemap.layers['triggers']
+
+    def fire(self, origin, location, direction, game):
+        '''Launch a bullet from the pool (growing it if it's empty.)
+        '''
+        if self._triggers is not game.tilemap.layers['triggers']:
+            self._load_triggers(game.tilemap)
+        if not self._free:
+            self._grow(2 * len(self._bullets))
+        i = self._free.popleft()
+        bullet = self._bullets[i]
+        if origin == 'player':
+            bullet.image = assets.image('bullet.png')
+        else:
+            bullet.image = assets.image('enemy-bullet.png')
+        bullet.rect = pygame.rect.Rect(location, bullet.image.get_size())
+        bullet.direction = direction
+        bullet.lifespan = 1
+        bullet.origin = origin
+        rect = bullet.rect
+        self._x[i], self._y[i] = rect.x, rect.y
+        self._w[i], self._h[i] = rect.width, rect.height
+        self._direction[i] = direction
+        self._lifespan[i] = 1
+        self._player[i] = origin == 'player'
+        self._active[i] = True
+        self._fired[i] = game.steps
+        self._candidates[i] = numpy.flatnonzero(
+            (self._top <= rect.bottom) & (self._bottom >= rect.top))
+        self.add(bullet)
+        return bullet
+
+    def _release(self, i):
+        if self._active[i]:
+            self._active[i] = False
+            self._bullets[i].kill()
+            self._free.append(i)
 
-            if 'r' in blockers and last.left >= cell.right and new.left < cell.right:
+    def update(self, dt, game):
+        live = numpy.flatnonzero(self._active & (self._fired < game.steps))
+        if not len(live):
+            return
+        x, y, w, h = self._x, self._y, self._w, self._h
+
+        # expire bullets whose lifespan has run out
+        self._lifespan[live] -= dt
+        expired = self._lifespan[live] < 0
+        for i in live[expired].tolist():
+            self._release(i)
+        live = live[~expired]
+
+        # move the bullets by 400 pixels per second in their movement
+        # direction, truncating as assigning to a Rect does
+        last = x[live]
+        x[live] = (last + self._direction[live] * 400 * dt).astype(int)
+        lx, ly, lw, lh = x[live], y[live], w[live], h[live]
+
+        # player bullets destroy every enemy they hit, looked up in the enemy
+        # layer's grid
+        for j in numpy.flatnonzero(self._player[live]).tolist():
+            impact = game.enemies.collide(pygame.Rect(int(lx[j]), int(ly[j]),
+                int(lw[j]), int(lh[j])))
+            if impact:
+                for enemy in impact:
+                    enemy.kill()
+                explosion = Explosion(game.explosion_images,
+                    impact[0].rect.center, 10, game.sprites)
+                # the sprite layer is updated after this one; like a bullet
+                # fired this step the explosion starts in the next one
+                explosion.born = game.steps
                 game.explosion.play()
-                self.kill()
+                game.score = game.score + 10
+                self._release(live[j])
+
+        # enemy bullets hurt the player
+        player = game.player.rect
+        hit = ~self._player[live] & (lx < player.right) & \
+            (lx + lw > player.left) & (ly < player.bottom) & \
+            (ly + lh > player.top)
+        for i in live[hit].tolist():
+            game.explosion.play()
+            game.health = game.health - 10
+            self._release(i)
+
+        # check for wall collisions so bullets can't be fired through; a
+        # bullet crossing or touching a blocker side sets off an explosion
+        counts = [len(self._candidates[i]) for i in live.tolist()]
+        if sum(counts):
+            bullets = numpy.repeat(numpy.arange(len(live)), counts)
+            triggers = numpy.concatenate([self._candidates[i]
+                for i in live.tolist()])
+            left, right = self._left[triggers], self._right[triggers]
+            new_left = lx[bullets]
+            new_right = new_left + lw[bullets]
+            last_left = last[bullets]
+            last_right = last_left + lw[bullets]
+            # the triggers passed on the way from the last position or touched
+            # at the new one, leaving out the side moved away from as
+            # swept_rects() does
+            moved = numpy.sign(new_left - last_left)
+            touching = (left <= numpy.maximum(new_right, last_right) -
+                (moved < 0)) & (right >= numpy.minimum(new_left, last_left) +
+                (moved > 0))
+            hit = touching & (self._blocks_left[triggers] |
+                self._blocks_right[triggers])
+            hit = numpy.bincount(bullets, hit, len(live))
+            for j in numpy.flatnonzero(hit).tolist():
+                game.explosion.play()
+                self._release(live[j])
+
+        # copy the new positions back to the bullets still in flight
+        bullets = self._bullets
+        moved = self.grid.move
+        for i in live[self._active[live]].tolist():
+            bullets[i].rect.x = int(x[i])
+            moved(bullets[i])
 
 # Our player of the game represented as a sprite with many attributes and user
 # control.
@@ -249,9 +913,9 @@ class Bullet(pygame.sprite.Sprite):
 class Player(pygame.sprite.Sprite):
     def __init__(self, location, *groups):
         super(Player, self).__init__(*groups)
-        self.image = pygame.image.load('player-right.png')
+        self.image = assets.image('player-right.png')
         self.right_image = self.image
-        self.left_image = pygame.image.load('player-left.png')
+        self.left_image = assets.image('player-left.png')
         self.rect = pygame.rect.Rect(location, self.image.get_size())
         # is the player resting on a surface and able to jump?
         self.resting = False
@@ -278,7 +942,7 @@ class Player(pygame.sprite.Sprite):
         last = self.rect.copy()
 
         # handle the player movement left/right keys
-        key = pygame.key.get_pressed()
+        key = game.input.pressed()
         
         if key[pygame.K_LEFT]:
             self.rect.x -= 300 * dt
@@ -302,9 +966,9 @@ class Player(pygame.sprite.Sprite):
             # create a bullet at an appropriate position (the side of the player
             # sprite) and travelling in the correct direction
             if self.direction > 0:
-                Bullet('player', self.rect.midright, 1, game.sprites)
+                game.fire('player', self.rect.midright, 1)
             else:
-                Bullet('player', self.rect.midleft, -1, game.sprites)
+                game.fire('player', self.rect.midleft, -1)
             # set the amount of time until the player can shoot again
             self.gun_cooldown = 0.25
             game.shoot.play()
@@ -338,9 +1002,10 @@ class Player(pygame.sprite.Sprite):
             else:
                 self.dy = -500
 
-        # add gravity on to the currect vertical speed
+        # add gravity (1000 pixels per second per second) on to the currect
+        # vertical speed
         if not self.on_ladder:
-            self.dy = min(400, self.dy + 40)
+            self.dy = min(400, self.dy + 1000 * dt)
 
         # now add the distance travelled for this update to the player position
         self.rect.y += self.dy * dt
@@ -356,23 +1021,23 @@ class Player(pygame.sprite.Sprite):
         self.on_wall = False
         self.on_ladder = False
 
-        # look up the tilemap triggers layer for all cells marked "action"
-        for cell in game.tilemap.layers['triggers'].collide(new, 'action'):
-            # find the actual value of the blockers property
-            actions = cell['action']
-            # now for each side set in the blocker check for collision; only
-            # collide if we transition through the blocker side (to avoid
-            # false-positives) and align the player with the side collided to
-            # make things neater
-            if 'l' in actions and new.right <= cell.right and new.left >= cell.left:
-                self.on_ladder = True
-                self.resting = True
-                self.dy = 0
-            if 'l' in actions and last.bottom <= cell.top and new.bottom > cell.top:
+        # look up the trigger grid for the ladders the player touches
+        grid = game.trigger_grid
+        # now check whether the player is within a ladder's sides, or has
+        # moved down through the top of one (to avoid false-positives), and
+        # align the player with the top to make things neater; the cells
+        # passed through on the way are checked too so that a long fall
+        # can't carry the player past the top
+        if grid.within(new, grid.LADDER, grid.LADDER_L, grid.LADDER_R):
+            self.on_ladder = True
+            self.resting = True
+            self.dy = 0
+        for x, y, x2, y2, bits in grid.cells(swept_rects(last, new)[1]):
+            if bits & grid.LADDER_T and last.bottom <= y and new.bottom > y:
                 self.on_ladder = True
                 self.resting = True
                 if not key[pygame.K_DOWN]:
-                    new.bottom = cell.top
+                    new.bottom = y
                 # reset the vertical speed if we land or hit the roof; this
                 # avoids strange additional vertical speed if there's a
                 # collision and the player then leaves the ladder
@@ -380,45 +1045,311 @@ class Player(pygame.sprite.Sprite):
                 self.dx = 0    
                 self.previous_wall = False
 
-        # look up the tilemap triggers layer for all cells marked "blockers"
-        for cell in game.tilemap.layers['triggers'].collide(new, 'blockers'):
-            # find the actual value of the blockers property
-            blockers = cell['blockers']
-            # now for each side set in the blocker check for collision; only
-            # collide if we transition through the blocker side (to avoid
-            # false-positives) and align the player with the side collided to
-            # make things neater
-            if 'l' in blockers and last.right <= cell.left and new.right > cell.left:
-                new.right = cell.left
+        # look up the trigger grid for the blocker sides along the edges of
+        # the cells the player passes on the way from its last position (so
+        # it can't pass through a blocker however far it moves in an update)
+        # or touches at its new one
+        across, down = grid.swept(last, new)
+        # now for each blocked side check for collision; only collide if we
+        # transition through the blocker side (to avoid false-positives) and
+        # align the player with the side collided to make things neater; a
+        # side is only passed through across if the player is still level
+        # with it on reaching it
+        dx, dy = new.x - last.x, new.y - last.y
+        for x, y, x2, y2, bits in across:
+            if bits & grid.EDGE_L and last.right <= x and new.right > x and \
+                    in_rows_at(last, dx, dy, x - last.right, y, y2):
+                new.right = x
                 self.on_wall = 'r'
-            if 'r' in blockers and last.left >= cell.right and new.left < cell.right:
-                new.left = cell.right
+            if bits & grid.EDGE_R and last.left >= x2 and new.left < x2 and \
+                    in_rows_at(last, dx, dy, x2 - last.left, y, y2):
+                new.left = x2
                 self.on_wall = 'l'
-            if 't' in blockers and last.bottom <= cell.top and new.bottom > cell.top:
+        for x, y, x2, y2, bits in down:
+            if bits & grid.EDGE_T and last.bottom <= y and new.bottom > y:
                 self.resting = True
-                new.bottom = cell.top
+                new.bottom = y
                 # reset the vertical speed if we land or hit the roof; this
                 # avoids strange additional vertical speed if there's a
                 # collision and the player then leaves the platform
                 self.dy = 0
                 self.dx = 0    
                 self.previous_wall = False
-            if 'b' in blockers and last.top >= cell.bottom and new.top < cell.bottom:
-                new.top = cell.bottom
+            if bits & grid.EDGE_B and last.top >= y2 and new.top < y2:
+                new.top = y2
                 self.dy = 0
                 self.dx = 0
 
         # re-focus the tilemap viewport on the player's new position
         game.tilemap.set_focus(new.x, new.y)
 
+#
+# The heads-up display showing the player's health, lives and score. The
+# display is composed once into a cached surface and only composed again
+# when one of the values shown changes.
+#
+class HUD(object):
+    def __init__(self):
+        self.font = pygame.font.Font('freesansbold.ttf', 18)
+        self.text_color = (255, 255, 255)
+        self.healthbar = assets.image('healthbar.png')
+        self.health_image = assets.image('health.png')
+        self.gameover = assets.image('gameover.png')
+        self.youwin = assets.image('youwin.png')
+        # the 1 pixel wide health image repeated across the whole bar; the
+        # current health is shown by blitting just the left part of it
+        self._health_strip = None
+        # the composed HUD and the (score, health, lives) it shows
+        self.surface = None
+        self.rect = None
+        self._shown = None
+
+    def refresh(self, score, health, lives):
+        # re-compose the HUD if any of the values shown have changed; return
+        # the screen areas that changed as a result
+        shown = (score, health, lives)
+        if shown == self._shown:
+            return []
+        old_rect = self.rect
+        self.surface = self.render(score, health, lives)
+        self.rect = self.surface.get_rect()
+        self._shown = shown
+        if old_rect is None:
+            return [self.rect]
+        return [old_rect, self.rect]
+
+    def draw(self, screen, score=None, health=None, lives=None):
+        if score is not None:
+            self.refresh(score, health, lives)
+        screen.blit(self.surface, (0, 0))
+
+    def health_strip(self, width):
+        if self._health_strip is None or self._health_strip.get_width() < width:
+            h = self.health_image.get_height()
+            strip = pygame.Surface((max(200, width), h), pygame.SRCALPHA, 32)
+            for x in range(strip.get_width()):
+                strip.blit(self.health_image, (x, 0))
+            self._health_strip = strip
+        return self._health_strip
+
+    def render(self, score, health, lives):
+        render = self.font.render
+        parts = [
+            (render('Health: ', 1, self.text_color), (20, 10)),
+            (render('Lives: %s' % (lives), 1, self.text_color), (20, 30)),
+            (render('Score: %s' % (score), 1, self.text_color), (20, 50)),
+            (self.healthbar, (90, 11)),
+        ]
+        width = max(x + part.get_width() for part, (x, y) in parts)
+        height = max(y + part.get_height() for part, (x, y) in parts)
+        health = max(0, health)
+        strip = self.health_strip(health)
+        width = max(width, 93 + health)
+        height = max(height, 14 + strip.get_height())
+
+        surface = pygame.Surface((width, height), pygame.SRCALPHA, 32)
+        for part, pos in parts:
+            surface.blit(part, pos)
+        # the bar is drawn with a single area blit of the health strip
+        surface.blit(strip, (93, 14), (0, 0, health, strip.get_height()))
+        return surface
+
+#
+# Renders the game by redrawing and updating only the areas of the screen
+# which changed since the previous frame. Any movement of the camera changes
+# everything so it falls back to a full redraw.
+#
+class DirtyRectRenderer(object):
+    def __init__(self, screen, background, max_rects=24):
+        self.screen = screen
+        self.background = background
+        # beyond this many separate rects just update their union
+        self.max_rects = max_rects
+        # the viewport drawn last frame; None forces a full redraw
+        self._view = None
+
+    def render(self, game):
+        screen = self.screen
+        hud_rects = game.hud.refresh(game.score, game.health, game.lives)
+        view = tuple(game.tilemap.viewport)
+        if view != self._view:
+            self._view = view
+            screen.blit(self.background, (0, 0))
+            game.tilemap.draw(screen)
+            game.hud.draw(screen)
+            if game.profiler is not None:
+                game.profiler.draw(screen)
+            pygame.display.update()
+            return
+
+        rects = list(hud_rects)
+        if game.profiler is not None and game.profiler.overlay_rect:
+            rects.append(game.profiler.overlay_rect)
+        for layer in game.tilemap.layers:
+            if layer.visible:
+                rects.extend(layer.dirty_rects())
+        rects = self.merge(rects)
+        if not rects:
+            return
+
+        # repaint the changed areas from the bottom up in a single pass,
+        # clipped to their union; the unchanged pixels within it are drawn
+        # just as they were, and only the changed areas are updated
+        screen.set_clip(rects[0].unionall(rects[1:]))
+        screen.blit(self.background, (0, 0))
+        game.tilemap.draw(screen)
+        game.hud.draw(screen)
+        if game.profiler is not None:
+            game.profiler.draw(screen)
+        screen.set_clip(None)
+        pygame.display.update(rects)
+
+    def merge(self, rects):
+        # clip the rects to the screen and combine any that overlap
+        bounds = self.screen.get_rect()
+        merged = []
+        for rect in rects:
+            rect = rect.clip(bounds)
+            if not rect.width or not rect.height:
+                continue
+            i = rect.collidelist(merged)
+            while i != -1:
+                rect = rect.union(merged.pop(i))
+                i = rect.collidelist(merged)
+            merged.append(rect)
+        if len(merged) > self.max_rects:
+            return [merged[0].unionall(merged[1:])]
+        return merged
+
+    def invalidate(self):
+        # force a full redraw on the next frame
+        self._view = None
+
+#
+# Player input comes from an input source. The game polls it once per frame
+# for quit requests and the player asks it which keys are held.
+#
+class KeyboardInput(object):
+    def poll(self):
+        # handle basic game events; return False if the window is closed or
+        # the escape key is pressed
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return False
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                return False
+        return True
+
+    def pressed(self):
+        return pygame.key.get_pressed()
+
+
+class KeyState(object):
+    # the held keys as a stand-in for pygame.key.get_pressed()
+    def __init__(self, keys=()):
+        self.keys = frozenset(keys)
+
+    def __getitem__(self, key):
+        return key in self.keys
+
+#
+# Input played back from a script rather than read from the keyboard. The
+# script is a list of (frame, keys) entries in frame order; from each entry's
+# frame onwards exactly those keys are held. Keys may be pygame key constants
+# or names such as 'left' or 'space'. If frames is given the script asks the
+# game to stop after that many frames.
+#
+class ScriptedInput(object):
+    def __init__(self, script=(), frames=None):
+        self.script = [(frame, KeyState(key_code(k) for k in keys))
+            for frame, keys in script]
+        self.frames = frames
+        self.frame = -1
+        self._next = 0
+        self._held = KeyState()
+
+    def poll(self):
+        self.frame += 1
+        if self.frames is not None and self.frame >= self.frames:
+            return False
+        while (self._next < len(self.script) and
+                self.script[self._next][0] <= self.frame):
+            self._held = self.script[self._next][1]
+            self._next += 1
+        return True
+
+    def pressed(self):
+        return self._held
+
+
+def key_code(key):
+    # accept a key name such as 'left' or 'lshift' as well as a key constant
+    if isinstance(key, int):
+        return key
+    return getattr(pygame, 'K_' + key.upper())
+
 #
 # Our game class represents one loaded level of the game and stores all the
 # actors and other game-level state.
 #
+# The simulation advances in fixed steps of 1/sim_hz seconds however fast
+# frames are drawn; drawing happens at up to fps frames per second and
+# interpolates sprite and camera positions between the last two steps. The
+# player and bullets are collided with blockers along the whole of each
+# step's movement, so the simulation can run at a low rate without them
+# passing through walls and platforms.
+#
 class Game(object):
-    def main(self, screen):
-        # grab a clock so we can limit and measure the passing of time
-        clock = pygame.time.Clock()
+    def __init__(self, dirty_rects=False, input=None, sim_hz=25, fps=25,
+            max_steps=5, interpolate=True, level='new-map.tmx', profiler=None,
+            swarm=None, pool=None, activity_margin=320, stream=False,
+            load_threads=4):
+        # redraw only what changed each frame rather than the whole screen
+        self.dirty_rects = dirty_rects
+        # where the player's key presses come from
+        if input is None:
+            input = KeyboardInput()
+        self.input = input
+        # simulation steps per second and the cap on frames drawn per second
+        self.sim_hz = sim_hz
+        self.fps = fps
+        # the most simulation steps run to catch up before a frame is drawn;
+        # any time still owed after that is dropped
+        self.max_steps = max_steps
+        # draw sprites between their last two simulated positions
+        self.interpolate = interpolate
+        self._previous = None
+        # the TMX map file to play
+        self.level = level
+        # a profiler.Profiler to record each frame with, if any
+        self.profiler = profiler
+        # update the enemies together as an EnemySwarm; by default whenever
+        # NumPy is available
+        if swarm is None:
+            swarm = numpy is not None
+        self.swarm = swarm
+        # fly bullets from a ProjectilePool; likewise by default whenever NumPy
+        # is available, and never without it (the bullets fly in the sprite
+        # layer instead, as the swarm updates each Enemy in turn)
+        if pool is None:
+            pool = numpy is not None
+        self.pool = pool and numpy is not None
+        # enemies further than this many pixels outside the view sleep until
+        # the view comes near them; None keeps them all awake
+        self.activity_margin = activity_margin
+        # stream the map's tile layers, decompressing only the regions near
+        # the view, for maps too large to hold whole
+        self.stream = stream
+        # how many threads decode the level's images and sounds at the start
+        self.load_threads = load_threads
+
+    def load(self, screen, progress=None):
+        self.screen = screen
+
+        # decode everything the level uses at once on a pool of threads,
+        # calling progress(done, total) as each file is loaded
+        assets.preload(IMAGES + tmx.tileset_images(self.level), SOUNDS,
+            self.load_threads, progress)
 
         # Lets keep score
         self.score = 0
@@ -429,116 +1360,337 @@ class Game(object):
 
         # we draw the background as a static image so we can just load it in the
         # main loop
-        background = pygame.image.load('background.png')
+        self.background = assets.image('background.png')
 
         # load our tilemap and set the viewport for rendering to the screen's
-        # size
-        self.tilemap = tmx.load('new-map.tmx', screen.get_size())
+        # size; the tilesets' images come through the shared asset cache so
+        # the tiles are packed into its atlas along with the sprites
+        self.tilemap = tmx.load(self.level, screen.get_size(),
+            stream=self.stream, load_image=assets.image)
+
+        # bullets fly in the sprite layer unless there's a projectile pool
+        if self.pool:
+            self.projectiles = ProjectilePool()
+            self.tilemap.layers.append(self.projectiles)
+        else:
+            self.projectiles = None
+        # simulation steps run so far
+        self.steps = 0
 
         # add a layer for our sprites controlled by the tilemap scrolling
         self.sprites = tmx.SpriteLayer()
         self.tilemap.layers.append(self.sprites)
+        # rasterize the triggers the sprites collide with
+        self.trigger_grid = TriggerGrid(self.tilemap.layers['triggers'],
+            self.tilemap.tile_width, self.tilemap.tile_height)
         # fine the player start cell in the triggers layer
-        start_cell = self.tilemap.layers['triggers'].find('player')[0]
+        self.start_cell = self.tilemap.layers['triggers'].find('player')[0]
         # use the "pixel" x and y coordinates for the player start
-        self.player = Player((start_cell.px, start_cell.py), self.sprites)
+        self.player = Player((self.start_cell.px, self.start_cell.py), self.sprites)
 
         # add a separate layer for enemies so we can find them more easily later
-        self.enemies = tmx.SpriteLayer()
+        if self.swarm:
+            self.enemies = EnemySwarm()
+        else:
+            self.enemies = tmx.SpriteLayer()
+        self.enemies.activity_margin = self.activity_margin
         self.tilemap.layers.append(self.enemies)
         # add an enemy for each "enemy" trigger in the map
         for enemy in self.tilemap.layers['triggers'].find('enemy'):
             Enemy((enemy.px, enemy.py), self.enemies)
 
         # add a separate layer for coins so we can find them more easily later
-        self.coins = tmx.SpriteLayer()
+        self.coins = CoinLayer()
         self.tilemap.layers.append(self.coins)
         # add an coin for each "coin" trigger in the map
         for coin in self.tilemap.layers['triggers'].find('coin'):
             Collectable((coin.px, coin.py), self.coins)
 
+        # start with the viewport on the player in case a frame is drawn
+        # before the first simulation step
+        self.tilemap.set_focus(self.player.rect.x, self.player.rect.y)
+
         self.explosion_images = load_sliced_sprites(0, 20, 20, 'explosion-sprite.png')
 
         # load the sound effects used in playing a level of the game
-        self.jump = pygame.mixer.Sound('jump.wav')
-        self.shoot = pygame.mixer.Sound('shoot.wav')
-        self.explosion = pygame.mixer.Sound('explosion.wav')
+        self.jump = assets.sound('jump.wav')
+        self.shoot = assets.sound('shoot.wav')
+        self.explosion = assets.sound('explosion.wav')
+
+        # the score, health and lives display
+        self.hud = HUD()
+
+        if self.dirty_rects:
+            self.renderer = DirtyRectRenderer(screen, self.background)
+        else:
+            self.renderer = None
+
+    def update(self, dt):
+        # update the tilemap and everything in it passing the elapsed time
+        # since the last update (in seconds) and this Game object
+        self.steps += 1
+        self.tilemap.update(dt, self)
+
+    def fire(self, origin, location, direction):
+        # launch a bullet fired by origin ('player' or 'enemy') from location,
+        # travelling left (-1) or right (1)
+        if self.projectiles is not None:
+            return self.projectiles.fire(origin, location, direction, self)
+        return Bullet(origin, location, direction, self.sprites)
+
+    def snapshot(self):
+        # remember where the sprites and camera are before a simulation step
+        # so drawing can interpolate from there
+        self._previous = dict((sprite, sprite.rect.topleft)
+            for layer in self.tilemap.layers
+                if isinstance(layer, tmx.SpriteLayer)
+                    for sprite in layer.sprites())
+        self._previous_focus = (self.tilemap.fx, self.tilemap.fy)
+
+    def draw(self, alpha=None):
+        # draw the scene alpha (0 to 1) of the way from the previous
+        # simulation step to the current one, or as it is now if alpha is None
+        if alpha is None or not self.interpolate or self._previous is None:
+            self.draw_scene()
+            return
+
+        # move the sprites and camera back to their in-between positions,
+        # skipping any that jumped (eg. the player respawning)
+        moved = []
+        for sprite, (px, py) in self._previous.items():
+            if not sprite.alive():
+                continue
+            x, y = sprite.rect.topleft
+            if (x, y) == (px, py) or abs(x - px) > 64 or abs(y - py) > 64:
+                continue
+            moved.append((sprite, x, y))
+            sprite.rect.topleft = (px + (x - px) * alpha, py + (y - py) * alpha)
+        tilemap = self.tilemap
+        fx, fy = tilemap.fx, tilemap.fy
+        pfx, pfy = self._previous_focus
+        if abs(fx - pfx) <= 64 and abs(fy - pfy) <= 64:
+            tilemap.set_focus(pfx + (fx - pfx) * alpha, pfy + (fy - pfy) * alpha)
+
+        self.draw_scene()
+
+        # and put everything back where the simulation has it
+        for sprite, x, y in moved:
+            sprite.rect.topleft = (x, y)
+        tilemap.set_focus(fx, fy)
+
+    def draw_scene(self):
+        # construct the scene by drawing the background and then the rest of
+        # the game imagery over the top
+        if self.renderer is not None:
+            self.renderer.render(self)
+            return
+        screen = self.screen
+        screen.blit(self.background, (0, 0))
+        self.tilemap.draw(screen)
+        self.hud.draw(screen, self.score, self.health, self.lives)
+        if self.profiler is not None:
+            self.profiler.draw(screen)
+        pygame.display.update()
+
+    def check_state(self):
+        # lose a life if the player has died; return 'gameover' when the last
+        # life has gone, 'win' when the player reaches the exit, otherwise None
+
+        # a simple change here could be to replace the "print" with the
+        # invocation of a simple "game over" scene
+        #if self.player.is_dead:
+        if self.health <= 0:
+            self.lives = self.lives - 1
+            self.health = 200
+            self.explosion.play()
+            self.player.rect = pygame.rect.Rect((self.start_cell.px, self.start_cell.py), self.player.image.get_size())
+
+        if self.lives == 0:
+            return 'gameover'
+
+        if self.trigger_grid.touches(self.player.rect, TriggerGrid.EXIT):
+            return 'win'
+        return None
+
+    def main(self, screen):
+        # grab a clock so we can limit and measure the passing of time
+        clock = pygame.time.Clock()
+
+        self.load(screen, lambda done, total: draw_progress(screen, done,
+            total))
+
+        # simulation time owed but not yet run
+        step = 1. / self.sim_hz
+        lag = 0.
 
         while 1:
-            # limit updates to 30 times per second and determine how much time
-            # passed since the last update
-            dt = clock.tick(25)
-
-            # handle basic game events; terminate this main loop if the window
-            # is closed or the escape key is pressed
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    return
-                if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
-                    return
-
-            # update the tilemap and everything in it passing the elapsed time
-            # since the last update (in seconds) and this Game object
-            self.tilemap.update(dt / 1000., self)
-            # construct the scene by drawing the background and then the rest of
-            # the game imagery over the top
-            screen.blit(background, (0, 0))
-            self.tilemap.draw(screen)
-
-            basicFont = pygame.font.Font('freesansbold.ttf', 18)
-            textColor = (255, 255, 255)
-
-            scoreSurf = basicFont.render('Score: %s' % (self.score), 1, textColor)
-            scoreRect = scoreSurf.get_rect()
-            scoreRect.topleft = (20, 50)
-            screen.blit(scoreSurf, scoreRect)
-            
-            healthSurf = basicFont.render('Health: ', 1, textColor)
-            healthRect = healthSurf.get_rect()
-            healthRect.topleft = (20, 10)
-            screen.blit(healthSurf, healthRect)
-
-            healthbar = pygame.image.load("healthbar.png")
-            health = pygame.image.load("health.png")
-
-            screen.blit(healthbar, (90,11))
-            for health1 in range(self.health):
-                screen.blit(health, (health1+93,14))
-
-            livesSurf = basicFont.render('Lives: %s' % (self.lives), 1, textColor)
-            livesRect = livesSurf.get_rect()
-            livesRect.topleft = (20, 30)
-            screen.blit (livesSurf, livesRect)
-            
-            pygame.display.update()
+            # limit drawing to fps times per second and determine how much
+            # time passed since the last frame
+            lag += clock.tick(self.fps) / 1000.
+            if self.profiler is not None:
+                self.profiler.begin_frame()
+
+            # terminate this main loop if the window is closed or the escape
+            # key is pressed
+            if not self.input.poll():
+                return
 
-            # terminate this main loop if the player dies; a simple change here
-            # could be to replace the "print" with the invocation of a simple
-            # "game over" scene
-            #if self.player.is_dead:
-            if self.health <= 0:
-                self.lives = self.lives - 1
-                self.health = 200
-                self.explosion.play()
-                self.player.rect = pygame.rect.Rect((start_cell.px, start_cell.py), self.player.image.get_size())
-
-            gameover = pygame.image.load("gameover.png")
-            youwin = pygame.image.load("youwin.png")
-
-            if self.lives == 0:
-                screen.blit(gameover, (0,0))
+            # run as many fixed steps as the time passed calls for (within
+            # the catch-up cap), noting positions before the last of them
+            steps = min(int(lag / step), self.max_steps)
+            state = None
+            for i in range(steps):
+                if i == steps - 1:
+                    self.snapshot()
+                self.update(step)
+                lag -= step
+                # terminate this main loop if the player dies or wins
+                state = self.check_state()
+                if state is not None:
+                    break
+            if lag >= step:
+                # we're too far behind to catch up; drop the time owed
+                lag %= step
+
+            self.draw(lag / step)
+            if self.profiler is not None:
+                self.profiler.end_frame()
+
+            if state == 'gameover':
+                screen.blit(self.hud.gameover, (0,0))
                 pygame.display.update()
                 return
 
-            if self.tilemap.layers['triggers'].collide(self.player.rect, 'exit'):
-                screen.blit(youwin, (0,0))
+            if state == 'win':
+                screen.blit(self.hud.youwin, (0,0))
                 pygame.display.update()
                 return
 
-if __name__ == '__main__':
-    # if we're invoked as a program then initialise pygame, create a window and
-    # run the game
+    def simulate(self, screen, frames, dt=None, render=False):
+        # run the game as fast as possible for up to the given number of
+        # frames of dt seconds each (one simulation step by default), drawing
+        # only if asked to; return the final state ('gameover', 'win' or None)
+        if dt is None:
+            dt = 1. / self.sim_hz
+        self.load(screen)
+        self.frames = 0
+        state = None
+        profiler = self.profiler
+        while self.frames < frames and self.input.poll():
+            if profiler is not None:
+                profiler.begin_frame()
+            self.update(dt)
+            if render:
+                self.draw()
+            if profiler is not None:
+                profiler.end_frame()
+            self.frames += 1
+            state = self.check_state()
+            if state is not None:
+                break
+        return state
+
+
+def draw_progress(screen, done, total):
+    # show a loading bar done / total of the way across the screen
+    w, h = screen.get_size()
+    screen.fill((0, 0, 0))
+    bar = pygame.Rect(w // 4, h // 2 - 5, w // 2, 10)
+    pygame.draw.rect(screen, (255, 255, 255), bar, 1)
+    bar.width = bar.width * done // total
+    screen.fill((255, 255, 255), bar)
+    pygame.display.update()
+    # keep the window responsive while loading
+    pygame.event.pump()
+
+
+def headless_screen(size=(640, 360)):
+    # initialise pygame on the SDL dummy video and audio drivers and return
+    # an off-screen display surface; this must happen before pygame is
+    # initialised with any other driver
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
     pygame.init()
-    screen = pygame.display.set_mode((640, 360))
-    Game().main(screen)
+    return pygame.display.set_mode(size)
+
 
+def load_script(filename):
+    # load an input script: a JSON list of [frame, [key names]] entries
+    with open(filename) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dirty-rects', action='store_true',
+        help='only redraw the parts of the screen that change')
+    parser.add_argument('--headless', type=int, metavar='FRAMES',
+        help='simulate this many frames without a window')
+    parser.add_argument('--script', metavar='FILE',
+        help='play back player input from a JSON key script')
+    parser.add_argument('--render', action='store_true',
+        help='draw each frame when running headless')
+    parser.add_argument('--sim-hz', type=int, default=25,
+        help='simulation steps per second')
+    parser.add_argument('--fps', type=int, default=25,
+        help='most frames drawn per second')
+    parser.add_argument('--profile', action='store_true',
+        help='time each frame and show a frame-time graph')
+    parser.add_argument('--profile-out', metavar='FILE',
+        help='write the per-frame profile records to FILE as JSON lines')
+    parser.add_argument('--no-swarm', dest='swarm', action='store_false',
+        default=None, help='update each enemy separately rather than as a '
+        'NumPy swarm')
+    parser.add_argument('--no-pool', dest='pool', action='store_false',
+        default=None, help='update each bullet separately rather than from '
+        'a NumPy projectile pool')
+    parser.add_argument('--activity-margin', type=int, default=320,
+        metavar='PIXELS', help='how far outside the view enemies stay awake')
+    parser.add_argument('--no-sleep', dest='activity_margin',
+        action='store_const', const=None, help='keep every enemy awake')
+    parser.add_argument('--stream', action='store_true',
+        help='stream the map, only decompressing the parts near the view')
+    parser.add_argument('--load-threads', type=int, default=4,
+        metavar='N', help='threads to load images and sounds with')
+    args = parser.parse_args()
+
+    if args.script:
+        input = ScriptedInput(load_script(args.script))
+    else:
+        input = None
+
+    if args.profile or args.profile_out:
+        prof = profiler.Profiler(overlay=args.profile)
+        prof.install([Player, Enemy, EnemySwarm, Bullet, ProjectilePool,
+            Collectable, Explosion], TriggerGrid)
+    else:
+        prof = None
+
+    if args.headless is not None:
+        screen = headless_screen()
+        game = Game(args.dirty_rects, input or ScriptedInput(), args.sim_hz,
+            args.fps, profiler=prof, swarm=args.swarm, pool=args.pool,
+            activity_margin=args.activity_margin, stream=args.stream,
+            load_threads=args.load_threads)
+        start = time.time()
+        state = game.simulate(screen, args.headless, render=args.render)
+        elapsed = time.time() - start
+        print('%d frames in %.2fs (%.0f fps): %s, score %d, health %d, '
+            'lives %d' % (game.frames, elapsed, game.frames / max(elapsed, 1e-6),
+            state or 'running', game.score, game.health, game.lives))
+        if prof is not None:
+            for label, (p50, p95, p99) in sorted(prof.summary().items()):
+                print('%-20s p50 %7.3fms  p95 %7.3fms  p99 %7.3fms' % (label,
+                    p50, p95, p99))
+    else:
+        # if we're invoked as a program then initialise pygame, create a
+        # window and run the game
+        pygame.init()
+        screen = pygame.display.set_mode((640, 360))
+        Game(args.dirty_rects, input, args.sim_hz, args.fps,
+            profiler=prof, swarm=args.swarm, pool=args.pool,
+            activity_margin=args.activity_margin, stream=args.stream,
+            load_threads=args.load_threads).main(screen)
+
+    if args.profile_out:
+        prof.dump(args.profile_out)
@@ -0,0 +1,161 @@
+"""Per-frame profiling for the platformer.
+
+A Profiler wraps the game's hot paths (map update, each sprite class's
+update, tile layer drawing, trigger collision queries and the display
+update) with timers and call counters, and keeps one record per frame in a
+ring buffer. Collision queries are the triggers layer's collide() and the
+lookups in the game's TriggerGrid, timed together under "collide". Nothing is wrapped until install() is called, so a game
+without a profiler pays nothing for it.
+
+Timings are inclusive: "tilemap.update" includes the sprite updates and
+collision queries made during it.
+"""
+# This file is part of platformer and is distributed under the same terms
+# (GNU General Public License version 3 or later) as platformer.py.
+
+import json
+from collections import deque
+from timeit import default_timer as timer
+
+import pygame
+import tmx
+
+
+class Profiler(object):
+    '''Collects per-frame timings and call counts.
+
+    Profilers have some basic properties:
+
+        records - a deque of the most recent per-frame records, each a dict
+                  with "frame", "frame_ms", "timers" (label -> ms) and
+                  "calls" (label -> count)
+        overlay - whether draw() shows the frame-time graph
+    '''
+    # the frame time shown at the top of the graph, and the frame time above
+    # which bars are drawn red (one frame at 25 fps), in milliseconds
+    graph_ms = 80
+    budget_ms = 40
+
+    def __init__(self, frames=600, overlay=False):
+        self.records = deque(maxlen=frames)
+        self.overlay = overlay
+        self.frame = 0
+        self.overlay_rect = None
+        self._timers = {}
+        self._calls = {}
+        self._start = None
+        self._installed = []
+        self._font = None
+
+    def wrap(self, owner, name, label):
+        '''Replace owner.name (a class's method or a module's function) with
+        a version timed under label.
+        '''
+        original = getattr(owner, name)
+        timers, calls = self._timers, self._calls
+        def timed(*args, **kw):
+            start = timer()
+            try:
+                return original(*args, **kw)
+            finally:
+                timers[label] = timers.get(label, 0.) + timer() - start
+                calls[label] = calls.get(label, 0) + 1
+        self._installed.append((owner, name, owner.__dict__.get(name)))
+        setattr(owner, name, timed)
+
+    def install(self, sprite_classes=(), trigger_grid=None):
+        '''Wrap the map and display hot paths and the update() of each of
+        the sprite classes given, and the lookups of the trigger grid class
+        given (the game's collision queries go to one rather than to the
+        triggers layer.)
+        '''
+        self.wrap(tmx.TileMap, 'update', 'tilemap.update')
+        self.wrap(tmx.Layer, 'draw', 'layer.draw')
+        self.wrap(tmx.ObjectLayer, 'collide', 'collide')
+        if trigger_grid is not None:
+            for name in ('cells', 'touches', 'within', 'span'):
+                self.wrap(trigger_grid, name, 'collide')
+        self.wrap(pygame.display, 'update', 'display.update')
+        for cls in sprite_classes:
+            self.wrap(cls, 'update', 'update.%s' % cls.__name__)
+
+    def uninstall(self):
+        '''Put back everything install() wrapped.
+        '''
+        while self._installed:
+            owner, name, original = self._installed.pop()
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+
+    def begin_frame(self):
+        self._timers.clear()
+        self._calls.clear()
+        self._start = timer()
+
+    def end_frame(self):
+        if self._start is None:
+            return
+        self.records.append(dict(frame=self.frame,
+            frame_ms=1000 * (timer() - self._start),
+            timers=dict((label, 1000 * t) for label, t in self._timers.items()),
+            calls=dict(self._calls)))
+        self.frame += 1
+        self._start = None
+
+    def summary(self):
+        '''Return the p50, p95 and p99 of the frame time and of each timer
+        over the frames recorded, in milliseconds.
+        '''
+        series = {'frame': [r['frame_ms'] for r in self.records]}
+        for record in self.records:
+            for label, ms in record['timers'].items():
+                series.setdefault(label, []).append(ms)
+        return dict((label, percentiles(values))
+            for label, values in series.items())
+
+    def dump(self, filename):
+        '''Write the recorded frames to filename as JSON lines.
+        '''
+        with open(filename, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record, sort_keys=True))
+                f.write('\n')
+
+    def draw(self, screen):
+        '''Draw the frame-time graph and percentiles in the bottom right of
+        the screen, if the overlay is on.
+        '''
+        if not self.overlay:
+            return
+        if self._font is None:
+            self._font = pygame.font.Font('freesansbold.ttf', 10)
+        w, h = 200, 60
+        sw, sh = screen.get_size()
+        rect = self.overlay_rect = pygame.Rect(sw - w - 4, sh - h - 4, w, h)
+        screen.fill((0, 0, 0), rect)
+        records = list(self.records)[-w:]
+        x = rect.right - len(records)
+        for record in records:
+            ms = record['frame_ms']
+            bar = min(h, int(h * ms / self.graph_ms))
+            color = (255, 80, 80) if ms > self.budget_ms else (80, 255, 80)
+            screen.fill(color, (x, rect.bottom - bar, 1, bar))
+            x += 1
+        if records:
+            p50, p95, p99 = percentiles([r['frame_ms'] for r in records])
+            text = self._font.render('p50 %.1f  p95 %.1f  p99 %.1f ms' % (p50,
+                p95, p99), 1, (255, 255, 255))
+            screen.blit(text, (rect.left + 2, rect.top + 2))
+
+
+def percentiles(values, points=(50, 95, 99)):
+    '''Return the nearest-rank percentiles of values at each of points.
+    '''
+    if not values:
+        return tuple(0. for p in points)
+    values = sorted(values)
+    n = len(values)
+    return tuple(values[min(n - 1, max(0, int(round(p / 100. * n)) - 1))]
+        for p in points)
@@ -4,15 +4,57 @@
 
 # TODO: support properties on more things
 
+import os
 import sys
+import json
+import mmap
+import zlib
+import array
+import base64
 import struct
+import hashlib
+import weakref
+import tempfile
 import pygame
+from collections import OrderedDict
 from pygame.locals import *
 from pygame import Rect
 from xml.etree import ElementTree
 
+# optional: zstd compressed layer data needs zstandard, and CSV layer data
+# is parsed faster with NumPy
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def load_image(file):
+    '''Load the image file for a Tileset. This is the default loader; pass
+    another as the load_image argument of load() to load tileset images
+    some other way, eg. through an image cache.
+    '''
+    return pygame.image.load(file).convert_alpha()
+
+
+def blit_all(surface, blits):
+    '''Draw each of the (source Surface, destination) pairs in blits onto
+    surface, in one call where pygame has Surface.blits().
+    '''
+    if hasattr(surface, 'blits'):
+        surface.blits(blits, 0)
+    else:
+        for source, dest in blits:
+            surface.blit(source, dest)
+
 
 class Tile(object):
+    __slots__ = ('gid', 'surface', 'tile_width', 'tile_height', 'properties')
+
     def __init__(self, gid, surface, tileset):
         self.gid = gid
         self.surface = surface
@@ -57,14 +99,22 @@ class Tileset(object):
         self.firstgid = firstgid
         self.tiles = []
         self.properties = {}
+        # the external .tsx file and the image files this tileset came from
+        self.source = None
+        self.images = []
 
     @classmethod
-    def fromxml(cls, tag, firstgid=None):
+    def fromxml(cls, tag, firstgid=None, load_image=load_image):
         if 'source' in tag.attrib:
             firstgid = int(tag.attrib['firstgid'])
-            with open(tag.attrib['source']) as f:
-                tileset = ElementTree.fromstring(f.read())
-            return cls.fromxml(tileset, firstgid)
+            source = tag.attrib['source']
+            def load():
+                with open(source) as f:
+                    tileset = ElementTree.fromstring(f.read())
+                tileset = cls.fromxml(tileset, firstgid, load_image)
+                tileset.source = source
+                return tileset
+            return registry.get(source, firstgid, load)
 
         name = tag.attrib['name']
         if firstgid is None:
@@ -77,16 +127,17 @@ class Tileset(object):
         for c in tag.getchildren():
             if c.tag == "image":
                 # create a tileset
-                tileset.add_image(c.attrib['source'])
+                tileset.add_image(c.attrib['source'], load_image)
             elif c.tag == 'tile':
                 gid = tileset.firstgid + int(c.attrib['id'])
                 tileset.get_tile(gid).loadxml(c)
         return tileset
 
-    def add_image(self, file):
-        image = pygame.image.load(file).convert_alpha()
+    def add_image(self, file, load_image=load_image):
+        image = load_image(file)
         if not image:
             sys.exit("Error creating new Tileset: file %s not found" % file)
+        self.images.append(file)
         id = self.firstgid
         for line in xrange(image.get_height() / self.tile_height):
             for column in xrange(image.get_width() / self.tile_width):
@@ -98,14 +149,198 @@ class Tileset(object):
     def get_tile(self, gid):
         return self.tiles[gid - self.firstgid]
 
+    def rebased(self, firstgid):
+        '''Return a copy of this tileset starting at firstgid. Its Tiles
+        share their surfaces and properties with this tileset's.
+        '''
+        tileset = Tileset(self.name, self.tile_width, self.tile_height,
+            firstgid)
+        tileset.properties = self.properties
+        tileset.source = self.source
+        tileset.images = self.images
+        for i, tile in enumerate(self.tiles):
+            copy = Tile(firstgid + i, tile.surface, self)
+            copy.properties = tile.properties
+            tileset.tiles.append(copy)
+        return tileset
+
+
+class TilesetRegistry(object):
+    '''The Tilesets loaded from external .tsx files, shared between all the
+    maps using them.
+
+    Tilesets are keyed off the resolved path and modification time of their
+    .tsx file, so a changed file is loaded afresh, and are held through weak
+    references, so a tileset is released once no map uses it. A map using a
+    tileset at another firstgid gets a copy rebased with Tileset.rebased(),
+    which shares the tiles' surfaces rather than loading the image again.
+
+    Tiles are shared too, so treat their properties as read-only; set
+    properties on Cells instead.
+
+    TilesetRegistries have some basic properties:
+
+        hits, misses, rebases - counters describing how the registry is doing
+    '''
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.rebases = 0
+        # (path, mtime, firstgid) -> Tileset, and (path, mtime) -> the
+        # Tileset most recently handed out at any firstgid
+        self._tilesets = weakref.WeakValueDictionary()
+        self._latest = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._tilesets)
+
+    def get(self, source, firstgid, load):
+        '''Return the tileset from the .tsx file source starting at
+        firstgid, calling load() to create it if no map holds it already.
+        '''
+        path = os.path.realpath(source)
+        key = (path, os.path.getmtime(path))
+        tileset = self._tilesets.get(key + (firstgid,))
+        if tileset is not None:
+            self.hits += 1
+            return tileset
+        latest = self._latest.get(key)
+        if latest is not None:
+            tileset = latest.rebased(firstgid)
+            self.rebases += 1
+        else:
+            tileset = load()
+            self.misses += 1
+        self._tilesets[key + (firstgid,)] = tileset
+        self._latest[key] = tileset
+        return tileset
+
+    def stats(self):
+        '''Return a dict of the registry's hit, miss and rebase counts and
+        the number of tilesets it holds.
+        '''
+        return dict(hits=self.hits, misses=self.misses, rebases=self.rebases,
+            size=len(self._tilesets))
+
+    def clear(self):
+        self._tilesets.clear()
+        self._latest.clear()
+
+
+# the registry shared by all maps
+registry = TilesetRegistry()
+
 
 class Tilesets(dict):
+    '''All the Tiles of a map keyed off gid. The Tilesets themselves are
+    listed, in the order they were added, in .sets.
+    '''
+    def __init__(self):
+        super(Tilesets, self).__init__()
+        self.sets = []
+
     def add(self, tileset):
+        self.sets.append(tileset)
         for i, tile in enumerate(tileset.tiles):
             i += tileset.firstgid
             self[i] = tile
 
 
+class PropertyIndex(object):
+    '''An inverted index from property name, and from (name, value), to the
+    Cells or Objects of a layer that have that property.
+
+    Items must support keys(), "in" and item lookup like Cell and Object do.
+    Lookups return items in the order they were added to the index.
+    '''
+    def __init__(self):
+        self.order = {}
+        self.by_name = {}
+        self.by_value = {}
+        # items whose value for a property can't be hashed, by property name
+        self.unhashable = {}
+        self._serial = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def clear(self):
+        self.order.clear()
+        self.by_name.clear()
+        self.by_value.clear()
+        self.unhashable.clear()
+
+    def add(self, item):
+        self.order[item] = self._serial
+        self._serial += 1
+        for key in item.keys():
+            self.add_property(item, key)
+
+    def remove(self, item):
+        for key in item.keys():
+            self.remove_property(item, key)
+        del self.order[item]
+
+    def add_property(self, item, key):
+        '''Record the item's current value for the property "key", if set.
+        '''
+        if key not in item:
+            return
+        self.by_name.setdefault(key, set()).add(item)
+        try:
+            self.by_value.setdefault((key, item[key]), set()).add(item)
+        except TypeError:
+            self.unhashable.setdefault(key, set()).add(item)
+
+    def remove_property(self, item, key):
+        '''Forget the item's current value for the property "key", if set.
+        '''
+        if key not in item:
+            return
+        self._discard(self.by_name, key, item)
+        try:
+            self._discard(self.by_value, (key, item[key]), item)
+        except TypeError:
+            self._discard(self.unhashable, key, item)
+
+    def _discard(self, table, key, item):
+        items = table.get(key)
+        if items is None:
+            return
+        items.discard(item)
+        if not items:
+            del table[key]
+
+    def _sorted(self, items):
+        return sorted(items, key=self.order.__getitem__)
+
+    def has_property(self, name):
+        '''Return whether any item has the named property set.
+        '''
+        return name in self.by_name
+
+    def having(self, name):
+        '''Return all items with the named property set.
+        '''
+        items = self.by_name.get(name)
+        if not items:
+            return []
+        return self._sorted(items)
+
+    def matching(self, name, value):
+        '''Return all items with the named property set to the value.
+        '''
+        try:
+            items = list(self.by_value.get((name, value), ()))
+        except TypeError:
+            items = [item for item in self.by_name.get(name, ())
+                if item[name] == value]
+        else:
+            items.extend(item for item in self.unhashable.get(name, ())
+                if item[name] == value)
+        return self._sorted(items)
+
+
 class Cell(object):
     '''Layers are made of Cells (or empty space).
 
@@ -124,6 +359,10 @@ class Cell(object):
     property from the cell - this will not affect the Tile or any other Cells
     using the Cell's Tile.
     '''
+    __slots__ = ('x', 'y', 'px', 'py', 'tile', 'topleft', 'left', 'right',
+        'top', 'bottom', 'center', '_added_properties', '_deleted_properties',
+        '_layer')
+
     def __init__(self, x, y, px, py, tile):
         self.x, self.y = x, y
         self.px, self.py = px, py
@@ -134,31 +373,58 @@ class Cell(object):
         self.top = py
         self.bottom = py + tile.tile_height
         self.center = (px + tile.tile_width // 2, py + tile.tile_height // 2)
-        self._added_properties = {}
-        self._deleted_properties = set()
+        # the added and deleted property overrides, created when first needed
+        self._added_properties = None
+        self._deleted_properties = None
+        # the Layer indexing this cell's properties, if any
+        self._layer = None
 
     def __repr__(self):
         return '<Cell %s,%s %d>' % (self.px, self.py, self.tile.gid)
 
     def __contains__(self, key):
-        if key in self._deleted_properties:
+        if self._deleted_properties and key in self._deleted_properties:
             return False
-        return key in self._added_properties or key in self.tile.properties
+        if self._added_properties and key in self._added_properties:
+            return True
+        return key in self.tile.properties
 
     def __getitem__(self, key):
-        if key in self._deleted_properties:
+        if self._deleted_properties and key in self._deleted_properties:
             raise KeyError(key)
-        if key in self._added_properties:
+        if self._added_properties and key in self._added_properties:
             return self._added_properties[key]
         if key in self.tile.properties:
             return self.tile.properties[key]
         raise KeyError(key)
 
     def __setitem__(self, key, value):
+        if self._layer is not None:
+            self._layer._property_changing(self, key)
+        if self._added_properties is None:
+            self._added_properties = {}
         self._added_properties[key] = value
+        if self._layer is not None:
+            self._layer._property_changed(self, key)
 
     def __delitem__(self, key):
+        if self._layer is not None:
+            self._layer._property_changing(self, key)
+        if self._deleted_properties is None:
+            self._deleted_properties = set()
         self._deleted_properties.add(key)
+        if self._layer is not None:
+            self._layer._property_changed(self, key)
+
+    def keys(self):
+        '''Return the names of all the properties set on this cell.
+        '''
+        keys = set(self.tile.properties)
+        if self._added_properties:
+            keys.update(self._added_properties)
+        if self._deleted_properties:
+            keys.difference_update(self._deleted_properties)
+        return list(keys)
 
     def intersects(self, other):
         '''Determine whether this Cell intersects with the other rect (which has
@@ -175,6 +441,907 @@ class Cell(object):
         return True
 
 
+class CellGrid(object):
+    '''Compact storage for the cells of a Layer, standing in for its cells
+    dict.
+
+    The layer's global tile ids are held in a flat row-major array and Cells
+    are created from them only when they're looked up, so every lookup of an
+    unchanged cell returns a new Cell. Cells which can't be re-created from
+    their gid - those with properties set or deleted, or using a Tile not in
+    the map's tilesets - are kept in the sparse overrides dict.
+    '''
+    def __init__(self, layer, gids=None):
+        self.layer = layer
+        self.width, self.height = layer.width, layer.height
+        self.tile_width, self.tile_height = layer.tile_width, layer.tile_height
+        self.tilesets = layer.tilesets
+        if gids is None:
+            gids = array.array('i', [0]) * (self.width * self.height)
+        self.gids = gids
+        self.overrides = {}
+
+    def _offset(self, pos):
+        x, y = pos
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return y * self.width + x
+        return -1
+
+    def get(self, pos, default=None):
+        cell = self.overrides.get(pos)
+        if cell is not None:
+            return cell
+        i = self._offset(pos)
+        if i < 0 or self.gids[i] < 1:
+            return default
+        x, y = pos
+        cell = Cell(x, y, x * self.tile_width, y * self.tile_height,
+            self.tilesets[self.gids[i]])
+        cell._layer = self.layer
+        return cell
+
+    def __getitem__(self, pos):
+        cell = self.get(pos)
+        if cell is None:
+            raise KeyError(pos)
+        return cell
+
+    def __contains__(self, pos):
+        if pos in self.overrides:
+            return True
+        i = self._offset(pos)
+        return i >= 0 and self.gids[i] > 0
+
+    def __setitem__(self, pos, cell):
+        x, y = pos
+        i = self._offset(pos)
+        tile = cell.tile
+        registered = tile.gid > 0 and self.tilesets.get(tile.gid) is tile
+        if i >= 0:
+            self.gids[i] = tile.gid if registered else 0
+        if (i >= 0 and registered and cell.px == x * self.tile_width and
+                cell.py == y * self.tile_height and
+                not cell._added_properties and not cell._deleted_properties):
+            self.overrides.pop(pos, None)
+        else:
+            self.overrides[pos] = cell
+
+    def __delitem__(self, pos):
+        if pos not in self:
+            raise KeyError(pos)
+        self.overrides.pop(pos, None)
+        i = self._offset(pos)
+        if i >= 0:
+            self.gids[i] = 0
+
+    def __len__(self):
+        return sum(1 for pos in self)
+
+    def __iter__(self):
+        width = self.width
+        overrides = self.overrides
+        for i, gid in enumerate(self.gids):
+            pos = (i % width, i // width)
+            if gid > 0 or pos in overrides:
+                yield pos
+        for pos in overrides:
+            if self._offset(pos) < 0:
+                yield pos
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self.get(pos) for pos in self]
+
+    def items(self):
+        return [(pos, self.get(pos)) for pos in self]
+
+
+def _pin_override(cells, cell):
+    # the cell is about to be changed so it can no longer be re-created from
+    # its gid; keep it as an override of cells, unless it's since been
+    # replaced there, in which case it's detached from the layer just as it
+    # would have been from a cells dict
+    pos = cell.x, cell.y
+    if pos in cells.overrides:
+        stored = cells.overrides[pos] is cell
+    else:
+        found = cells.get(pos)
+        stored = found is not None and found.tile is cell.tile
+    if stored:
+        cells.overrides[pos] = cell
+    else:
+        cell._layer = None
+
+
+class GridPropertyIndex(object):
+    '''The property index of a Layer stored in a CellGrid.
+
+    Cell properties come from their Tiles so cells are found by scanning
+    the layer's gids for those of the tiles with a property (with NumPy if
+    it's available), plus any overridden cells, without creating a Cell for
+    every tile in the layer. The gids with each property are worked out once;
+    call reindex() on the layer after changing the properties of its Tiles.
+    Offers the same queries as PropertyIndex; results are in (x, y) order.
+    '''
+    def __init__(self, cells):
+        self.cells = cells
+        # property name -> the gids of the tiles with it
+        self._gids = {}
+
+    def clear(self):
+        self._gids = {}
+
+    def add(self, cell):
+        pass
+
+    def remove(self, cell):
+        pass
+
+    def remove_property(self, cell, key):
+        _pin_override(self.cells, cell)
+
+    def add_property(self, cell, key):
+        pass
+
+    def _gids_with(self, name):
+        gids = self._gids.get(name)
+        if gids is None:
+            gids = self._gids[name] = frozenset(gid for gid, tile in
+                self.cells.tilesets.items() if name in tile.properties)
+        return gids
+
+    def _offsets(self, gids):
+        # the offsets into the layer's gids of the tiles using one of gids
+        if not gids:
+            return []
+        if numpy is not None:
+            found = numpy.in1d(numpy.frombuffer(self.cells.gids, numpy.intc),
+                list(gids))
+            return numpy.flatnonzero(found).tolist()
+        return [i for i, gid in enumerate(self.cells.gids) if gid in gids]
+
+    def has_property(self, name):
+        gids = self._gids_with(name)
+        if gids:
+            if numpy is not None:
+                if numpy.in1d(numpy.frombuffer(self.cells.gids, numpy.intc),
+                        list(gids)).any():
+                    return True
+            elif any(gid in gids for gid in self.cells.gids):
+                return True
+        return any(name in cell for cell in self.cells.overrides.values())
+
+    def having(self, name):
+        overrides = self.cells.overrides
+        width = self.cells.width
+        found = set(pos for pos in ((i % width, i // width)
+            for i in self._offsets(self._gids_with(name)))
+            if pos not in overrides)
+        found.update(pos for pos, cell in overrides.items() if name in cell)
+        return [self.cells.get(pos) for pos in sorted(found)]
+
+    def matching(self, name, value):
+        return [cell for cell in self.having(name) if cell[name] == value]
+
+
+class ArraySource(object):
+    '''The gids of a streamed layer held whole in an array (or any sequence
+    of ints), for a RegionGrid to read from.
+    '''
+    def __init__(self, gids):
+        if not isinstance(gids, array.array):
+            gids = array.array('i', gids)
+        self.gids = gids
+
+    def read(self, start, count):
+        '''Return count gids from the index start as an array; fewer if the
+        layer ends first.
+        '''
+        return self.gids[start:start + count]
+
+
+class BufferSource(object):
+    '''The little-endian 32-bit gids of a streamed layer held at offset
+    within a bytes-like buffer, such as an mmap of a compiled map. Only the
+    gids read are copied out of it.
+    '''
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        self.offset = offset
+
+    def read(self, start, count):
+        i = self.offset + 4 * start
+        data = self.buffer[i:i + 4 * count]
+        return gid_array(data[:len(data) - len(data) % 4])
+
+
+class InflateSource(object):
+    '''The zlib (or with wbits 16 + zlib.MAX_WBITS, gzip) compressed gids of
+    a streamed layer, decompressed only as far as they're read.
+
+    The state of the decompressor is kept at the start of every read and
+    every count gids skipped over, so the gids from there on can be read
+    again without decompressing everything before them.
+    '''
+    # the most compressed bytes fed to the decompressor at once
+    piece = 64 * 1024
+
+    def __init__(self, data, wbits=zlib.MAX_WBITS):
+        self.data = data
+        # (decompressor, bytes of data consumed) keyed off the index of the
+        # gid they have reached
+        self.checkpoints = {0: (zlib.decompressobj(wbits), 0)}
+
+    def _inflate(self, d, pos, count):
+        # decompress up to count more gids, returning them as bytes and the
+        # new input offset
+        size = 4 * count
+        parts = []
+        while size:
+            chunk = self.data[pos:pos + self.piece]
+            out = d.decompress(chunk, size)
+            pos += len(chunk) - len(d.unconsumed_tail)
+            if not out and not d.unconsumed_tail:
+                if not chunk or d.unused_data:
+                    break   # the data ends short
+                continue
+            parts.append(out)
+            size -= len(out)
+        return b''.join(parts), pos
+
+    def read(self, start, count):
+        at = max(k for k in self.checkpoints if k <= start)
+        d, pos = self.checkpoints[at]
+        d = d.copy()
+        while at < start:
+            step = min(count, start - at)
+            data, pos = self._inflate(d, pos, step)
+            if len(data) < 4 * step:
+                return array.array('i')
+            at += step
+            self.checkpoints[at] = (d.copy(), pos)
+        data, pos = self._inflate(d, pos, count)
+        if len(data) == 4 * count:
+            self.checkpoints.setdefault(start + count, (d, pos))
+        return gid_array(data[:len(data) - len(data) % 4])
+
+
+class RegionGrid(object):
+    '''Streamed storage for the cells of a Layer, standing in for its cells
+    dict as a CellGrid does.
+
+    The layer is split into square regions of region_size tiles, read from
+    source (an ArraySource, BufferSource or InflateSource) a band of
+    region_size rows at a time the first time one of their cells is looked
+    up. A region then stays resident until it is evicted. focus(), called as
+    the map's viewport moves, loads the regions around the view and evicts
+    the least recently used of the others once the resident regions take
+    more than budget bytes. Evicted regions are read from the source again
+    when next needed, except changed ones, which are kept zlib compressed.
+
+    Cells with properties set or deleted, or using a Tile not in the map's
+    tilesets, are kept in the overrides dict and never evicted.
+    '''
+    def __init__(self, layer, source=None, region_size=32,
+            budget=4 * 1024 * 1024):
+        self.layer = layer
+        self.width, self.height = layer.width, layer.height
+        self.tile_width, self.tile_height = layer.tile_width, layer.tile_height
+        self.tilesets = layer.tilesets
+        self.region_size = region_size
+        self.budget = budget
+        if source is not None and not hasattr(source, 'read'):
+            source = ArraySource(source)
+        # where the gids of unchanged regions are read from; None if the
+        # layer started out empty
+        self.source = source
+        # the last band read from the source, as (band row, gids)
+        self._band = None
+        # compressed gids of the changed regions evicted, keyed off region
+        # (column, row) index
+        self.blobs = {}
+        # the set of gids used by each region seen so far, keyed off region;
+        # it may hold gids no longer used
+        self._used = {}
+        # decompressed regions, least recently used first
+        self.resident = OrderedDict()
+        self.resident_bytes = 0
+        self.dirty = set()
+        self.overrides = {}
+        self.loads = 0
+        self.evictions = 0
+        self._last = None
+
+    def _extent(self, key):
+        # the width and height in cells of region key
+        s = self.region_size
+        return (min(s, self.width - key[0] * s),
+            min(s, self.height - key[1] * s))
+
+    def _keys(self):
+        # the keys of the regions which may hold tiles, a band at a time
+        s = self.region_size
+        return [(ri, rj) for rj in range((self.height + s - 1) // s)
+            for ri in range((self.width + s - 1) // s)
+            if self._present((ri, rj))]
+
+    def _present(self, key):
+        # whether region key may hold tiles
+        if key in self.resident or key in self.blobs:
+            return True
+        used = self._used.get(key)
+        if used is None:
+            return self.source is not None
+        return bool(used)
+
+    def _read_band(self, rj):
+        # the gids of the band of regions in row rj, read from the source
+        if self._band is None or self._band[0] != rj:
+            s = self.region_size
+            count = min(s, self.height - rj * s) * self.width
+            gids = self.source.read(rj * s * self.width, count)
+            if len(gids) != count:
+                raise ValueError('layer %s holds fewer than %dx%d tiles' % (
+                    self.layer.name, self.width, self.height))
+            self._band = (rj, gids)
+        return self._band[1]
+
+    def _store(self, key, region):
+        used = set(region)
+        used.discard(0)
+        self._used[key] = used
+        if not used:
+            self.blobs.pop(key, None)
+            return
+        data = region.tostring() if hasattr(region, 'tostring') else \
+            region.tobytes()
+        self.blobs[key] = zlib.compress(data, 1)
+
+    def _decode(self, key):
+        blob = self.blobs.get(key)
+        if blob is not None:
+            region = array.array('i')
+            data = zlib.decompress(blob)
+            if hasattr(region, 'frombytes'):
+                region.frombytes(data)
+            else:
+                region.fromstring(data)
+            return region
+        w, h = self._extent(key)
+        if self.source is None or self._used.get(key) == set():
+            return array.array('i', [0]) * (w * h)
+        band = self._read_band(key[1])
+        x = key[0] * self.region_size
+        region = array.array('i')
+        for row in range(h):
+            region.extend(band[row * self.width + x:row * self.width + x + w])
+        if key not in self._used:
+            used = self._used[key] = set(region)
+            used.discard(0)
+        return region
+
+    def region(self, key):
+        '''Return the gids of region key, loading it if it isn't resident,
+        as a row-major array.
+        '''
+        if self._last is not None and self._last[0] == key:
+            return self._last[1]
+        region = self.resident.pop(key, None)
+        if region is None:
+            region = self._decode(key)
+            self.resident_bytes += len(region) * region.itemsize
+            self.loads += 1
+        # (re-)insert as the most recently used region
+        self.resident[key] = region
+        self._last = (key, region)
+        return region
+
+    def _peek(self, key):
+        # the gids of region key without making it resident
+        region = self.resident.get(key)
+        if region is None:
+            region = self._decode(key)
+        return region
+
+    def focus(self, x, y, w, h):
+        '''Load the regions within a region of the map-space pixel bounds
+        given, then evict the least recently used other regions until the
+        resident regions fit the budget.
+        '''
+        sw = self.region_size * self.tile_width
+        sh = self.region_size * self.tile_height
+        columns = (self.width + self.region_size - 1) // self.region_size
+        rows = (self.height + self.region_size - 1) // self.region_size
+        keep = set()
+        for rj in range(max(0, y // sh - 1), min(rows, (y + h) // sh + 2)):
+            for ri in range(max(0, x // sw - 1), min(columns, (x + w) // sw + 2)):
+                if self._present((ri, rj)):
+                    self.region((ri, rj))
+                    keep.add((ri, rj))
+        self.evict(keep)
+
+    def evict(self, keep=()):
+        '''Drop resident regions, least recently used first and other than
+        those in keep, until the resident regions fit the budget.
+        '''
+        for key in list(self.resident):
+            if self.resident_bytes <= self.budget:
+                break
+            if key in keep:
+                continue
+            region = self.resident.pop(key)
+            self.resident_bytes -= len(region) * region.itemsize
+            if key in self.dirty:
+                self.dirty.discard(key)
+                self._store(key, region)
+            if self._last is not None and self._last[0] == key:
+                self._last = None
+            self.evictions += 1
+
+    def _locate(self, pos):
+        # the region key and offset within it of cell index pos, or None
+        x, y = pos
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None, -1
+        s = self.region_size
+        key = (x // s, y // s)
+        w = min(s, self.width - key[0] * s)
+        return key, (y % s) * w + x % s
+
+    def _cell(self, x, y, gid):
+        cell = Cell(x, y, x * self.tile_width, y * self.tile_height,
+            self.tilesets[gid])
+        cell._layer = self.layer
+        return cell
+
+    def get(self, pos, default=None):
+        cell = self.overrides.get(pos)
+        if cell is not None:
+            return cell
+        key, i = self._locate(pos)
+        if key is None or not self._present(key):
+            return default
+        gid = self.region(key)[i]
+        if gid < 1:
+            return default
+        return self._cell(pos[0], pos[1], gid)
+
+    def __getitem__(self, pos):
+        cell = self.get(pos)
+        if cell is None:
+            raise KeyError(pos)
+        return cell
+
+    def __contains__(self, pos):
+        if pos in self.overrides:
+            return True
+        key, i = self._locate(pos)
+        if key is None or not self._present(key):
+            return False
+        return self.region(key)[i] > 0
+
+    def _set_gid(self, key, i, gid):
+        region = self.region(key)
+        region[i] = gid
+        self.dirty.add(key)
+        if gid > 0:
+            self._used.setdefault(key, set()).add(gid)
+
+    def __setitem__(self, pos, cell):
+        x, y = pos
+        key, i = self._locate(pos)
+        tile = cell.tile
+        registered = tile.gid > 0 and self.tilesets.get(tile.gid) is tile
+        if key is not None:
+            self._set_gid(key, i, tile.gid if registered else 0)
+        if (key is not None and registered and
+                cell.px == x * self.tile_width and
+                cell.py == y * self.tile_height and
+                not cell._added_properties and not cell._deleted_properties):
+            self.overrides.pop(pos, None)
+        else:
+            self.overrides[pos] = cell
+
+    def __delitem__(self, pos):
+        if pos not in self:
+            raise KeyError(pos)
+        self.overrides.pop(pos, None)
+        key, i = self._locate(pos)
+        if key is not None:
+            self._set_gid(key, i, 0)
+
+    def __len__(self):
+        return sum(1 for pos in self)
+
+    def positions(self, keys=None):
+        '''Yield the (position, gid) of every tile in the regions given (by
+        default all of them), a region at a time and a band of regions after
+        another, without making the regions resident.
+        '''
+        s = self.region_size
+        if keys is None:
+            keys = self._keys()
+        for key in sorted(keys, key=lambda key: (key[1], key[0])):
+            region = self._peek(key)
+            w, h = self._extent(key)
+            x0, y0 = key[0] * s, key[1] * s
+            for i, gid in enumerate(region):
+                if gid > 0:
+                    yield (x0 + i % w, y0 + i // w), gid
+
+    def __iter__(self):
+        overrides = self.overrides
+        for pos, gid in self.positions():
+            if pos not in overrides:
+                yield pos
+        for pos in overrides:
+            yield pos
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self.get(pos) for pos in self]
+
+    def items(self):
+        return [(pos, self.get(pos)) for pos in self]
+
+    @property
+    def gids(self):
+        '''All of the layer's gids as a row-major array.
+        '''
+        gids = array.array('i', [0]) * (self.width * self.height)
+        s = self.region_size
+        for key in self._keys():
+            region = self._peek(key)
+            w, h = self._extent(key)
+            x = key[0] * s
+            for row in range(h):
+                y = key[1] * s + row
+                gids[y * self.width + x:y * self.width + x + w] = \
+                    region[row * w:(row + 1) * w]
+        return gids
+
+    @property
+    def used(self):
+        '''The set of gids used by each region, keyed off region; reading
+        the regions not yet seen from the source.
+        '''
+        for key in self._keys():
+            if key not in self._used:
+                self._peek(key)
+        return self._used
+
+
+class ChunkGrid(object):
+    '''Sparse storage for the cells of an infinite Layer, standing in for
+    its cells dict as a CellGrid does.
+
+    The cells are held in the chunks of chunk_width by chunk_height cells
+    read from the layer's TMX <data>, keyed off the (x, y) index of their
+    top-left cell, which may be negative. Nothing is stored for the cells
+    outside every chunk, and a chunk is kept as the text read from the file
+    until one of its cells is first looked up. Setting a cell outside every
+    chunk creates a new chunk.
+
+    Cells with properties set or deleted, or using a Tile not in the map's
+    tilesets, are kept in the overrides dict.
+    '''
+    def __init__(self, layer, chunk_width=16, chunk_height=16,
+            encoding='base64', compression='zlib'):
+        self.layer = layer
+        self.tile_width, self.tile_height = layer.tile_width, layer.tile_height
+        self.tilesets = layer.tilesets
+        self.chunk_width, self.chunk_height = chunk_width, chunk_height
+        # the text of the chunks not yet decoded, and the encoding and
+        # compression it's in (see decode_data())
+        self.encoded = {}
+        self.encoding, self.compression = encoding, compression
+        # decoded chunks as row-major arrays of gids
+        self.decoded = {}
+        self.overrides = {}
+        self.decodes = 0
+        self._used = {}
+
+    def add_chunk(self, x, y, width, height, text):
+        '''Add the chunk of width by height cells with its top-left cell at
+        (x, y), encoded as text.
+        '''
+        if (width, height) != (self.chunk_width, self.chunk_height) or \
+                x % width or y % height:
+            raise ValueError('chunk at %d,%d is not an aligned %dx%d chunk' %
+                (x, y, self.chunk_width, self.chunk_height))
+        self.encoded[x, y] = text
+        self.decoded.pop((x, y), None)
+        self._used.pop((x, y), None)
+
+    def _decode(self, text):
+        gids = decode_data(text, self.encoding, self.compression)
+        if len(gids) != self.chunk_width * self.chunk_height:
+            raise ValueError('chunk holds %d tiles, not %d' % (len(gids),
+                self.chunk_width * self.chunk_height))
+        return gids
+
+    def chunk(self, key):
+        '''Return the gids of chunk key as a row-major array, decoding it
+        if it hasn't been, or None if there is no such chunk.
+        '''
+        gids = self.decoded.get(key)
+        if gids is None:
+            text = self.encoded.pop(key, None)
+            if text is None:
+                return None
+            gids = self.decoded[key] = self._decode(text)
+            self.decodes += 1
+        return gids
+
+    def _peek(self, key):
+        # the gids of chunk key without keeping them decoded
+        gids = self.decoded.get(key)
+        if gids is None:
+            gids = self._decode(self.encoded[key])
+        return gids
+
+    def _locate(self, pos):
+        # the chunk key and offset within it of cell index pos
+        x, y = pos
+        cw, ch = self.chunk_width, self.chunk_height
+        return (x - x % cw, y - y % ch), (y % ch) * cw + x % cw
+
+    def _cell(self, x, y, gid):
+        cell = Cell(x, y, x * self.tile_width, y * self.tile_height,
+            self.tilesets[gid])
+        cell._layer = self.layer
+        return cell
+
+    def get(self, pos, default=None):
+        cell = self.overrides.get(pos)
+        if cell is not None:
+            return cell
+        key, i = self._locate(pos)
+        gids = self.chunk(key)
+        if gids is None or gids[i] < 1:
+            return default
+        return self._cell(pos[0], pos[1], gids[i])
+
+    def __getitem__(self, pos):
+        cell = self.get(pos)
+        if cell is None:
+            raise KeyError(pos)
+        return cell
+
+    def __contains__(self, pos):
+        if pos in self.overrides:
+            return True
+        key, i = self._locate(pos)
+        gids = self.chunk(key)
+        return gids is not None and gids[i] > 0
+
+    def _set_gid(self, key, i, gid):
+        gids = self.chunk(key)
+        if gids is None:
+            if gid < 1:
+                return
+            gids = self.decoded[key] = array.array('i', [0]) * \
+                (self.chunk_width * self.chunk_height)
+        gids[i] = gid
+        if gid > 0 and key in self._used:
+            self._used[key].add(gid)
+
+    def __setitem__(self, pos, cell):
+        x, y = pos
+        key, i = self._locate(pos)
+        tile = cell.tile
+        registered = tile.gid > 0 and self.tilesets.get(tile.gid) is tile
+        self._set_gid(key, i, tile.gid if registered else 0)
+        if (registered and cell.px == x * self.tile_width and
+                cell.py == y * self.tile_height and
+                not cell._added_properties and not cell._deleted_properties):
+            self.overrides.pop(pos, None)
+        else:
+            self.overrides[pos] = cell
+
+    def __delitem__(self, pos):
+        if pos not in self:
+            raise KeyError(pos)
+        self.overrides.pop(pos, None)
+        key, i = self._locate(pos)
+        self._set_gid(key, i, 0)
+
+    def __len__(self):
+        return sum(1 for pos in self)
+
+    @property
+    def used(self):
+        '''The set of gids used by each chunk, keyed off chunk.
+        '''
+        for key in list(self.encoded) + list(self.decoded):
+            if key not in self._used:
+                used = self._used[key] = set(self._peek(key))
+                used.discard(0)
+        return self._used
+
+    def chunks(self):
+        '''Return the keys of all the chunks, decoded or not, in (x, y)
+        order.
+        '''
+        return sorted(set(self.encoded) | set(self.decoded))
+
+    def positions(self, keys=None):
+        '''Yield the (position, gid) of every tile in the chunks given (by
+        default all of them) without keeping them decoded.
+        '''
+        cw = self.chunk_width
+        if keys is None:
+            keys = self.chunks()
+        for key in keys:
+            x0, y0 = key
+            for i, gid in enumerate(self._peek(key)):
+                if gid > 0:
+                    yield (x0 + i % cw, y0 + i // cw), gid
+
+    def __iter__(self):
+        overrides = self.overrides
+        for pos, gid in self.positions():
+            if pos not in overrides:
+                yield pos
+        for pos in overrides:
+            yield pos
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self.get(pos) for pos in self]
+
+    def items(self):
+        return [(pos, self.get(pos)) for pos in self]
+
+    def bounds(self):
+        '''Return the (left, top, right, bottom) cell indexes bounding the
+        chunks and any overridden cells outside them, right and bottom being
+        exclusive, or None if there are neither.
+        '''
+        cw, ch = self.chunk_width, self.chunk_height
+        boxes = [(x, y, x + cw, y + ch) for x, y in self.chunks()]
+        boxes.extend((x, y, x + 1, y + 1) for x, y in self.overrides)
+        if not boxes:
+            return None
+        return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+    @property
+    def gids(self):
+        '''The gids within bounds() as a row-major array.
+        '''
+        bounds = self.bounds()
+        if bounds is None:
+            return array.array('i')
+        left, top, right, bottom = bounds
+        width = right - left
+        gids = array.array('i', [0]) * (width * (bottom - top))
+        cw = self.chunk_width
+        for (x0, y0) in self.chunks():
+            chunk = self._peek((x0, y0))
+            for row in range(self.chunk_height):
+                i = (y0 + row - top) * width + x0 - left
+                gids[i:i + cw] = chunk[row * cw:(row + 1) * cw]
+        return gids
+
+
+class RegionPropertyIndex(object):
+    '''The property index of a Layer stored in a RegionGrid or ChunkGrid.
+
+    Like GridPropertyIndex cells are found through the gids of the tiles
+    with a property, but only the regions using one of those gids are
+    searched, and they aren't made resident to do it. Results are in (x, y)
+    order.
+    '''
+    def __init__(self, cells):
+        self.cells = cells
+        # property name -> the gids of the tiles with it
+        self._gids = {}
+
+    def clear(self):
+        self._gids = {}
+
+    def add(self, cell):
+        pass
+
+    def remove(self, cell):
+        pass
+
+    def remove_property(self, cell, key):
+        _pin_override(self.cells, cell)
+
+    def add_property(self, cell, key):
+        pass
+
+    def _gids_with(self, name):
+        gids = self._gids.get(name)
+        if gids is None:
+            gids = self._gids[name] = frozenset(gid for gid, tile in
+                self.cells.tilesets.items() if name in tile.properties)
+        return gids
+
+    def has_property(self, name):
+        gids = self._gids_with(name)
+        if gids and any(gids & used for used in self.cells.used.values()):
+            return True
+        return any(name in cell for cell in self.cells.overrides.values())
+
+    def having(self, name):
+        cells = self.cells
+        gids = self._gids_with(name)
+        keys = sorted(key for key, used in cells.used.items() if gids & used)
+        overrides = cells.overrides
+        found = [(pos, gid) for pos, gid in cells.positions(keys)
+            if gid in gids and pos not in overrides]
+        found.extend((pos, None) for pos, cell in overrides.items()
+            if name in cell)
+        found.sort()
+        return [overrides[pos] if gid is None else cells._cell(pos[0], pos[1],
+            gid) for pos, gid in found]
+
+    def matching(self, name, value):
+        return [cell for cell in self.having(name) if cell[name] == value]
+
+
+def decode_data(text, encoding='base64', compression='zlib'):
+    '''Return the global tile ids held in the text of a TMX <data> or
+    <chunk> element as an array.
+
+    encoding is "csv" or "base64", and base64 data may be compressed with
+    "zlib", "gzip" or (if the zstandard module is installed) "zstd", or not
+    at all (compression None.) The ids are decoded straight into the array
+    without creating an int object per tile, except for CSV data when NumPy
+    isn't available.
+    '''
+    if encoding == 'csv':
+        if compression:
+            raise ValueError('CSV layer data cannot be compressed')
+        if numpy is not None:
+            gids = numpy.fromstring(text, dtype=numpy.int64, sep=',')
+            return gid_array(gids.astype('<i4').tobytes())
+        # gids with flip flags set don't fit an int; wrap them round as
+        # NumPy's astype() does, reading them as the 32 bits stored
+        gids = [int(gid) & 0xffffffff for gid in text.split(',')]
+        return array.array('i', [gid - 0x100000000 if gid & 0x80000000
+            else gid for gid in gids])
+    if encoding != 'base64':
+        raise ValueError('unsupported layer data encoding %s' % encoding)
+    data = base64.b64decode(text.strip())
+    if compression == 'zlib':
+        data = zlib.decompress(data)
+    elif compression == 'gzip':
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd layer data needs the zstandard module')
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif compression:
+        raise ValueError('unsupported layer data compression %s' % compression)
+    if len(data) % 4:
+        raise ValueError('layer data is not a whole number of tiles')
+    return gid_array(data)
+
+
+def gid_array(data):
+    '''Return the little-endian 32-bit global tile ids in the bytes data
+    as an array.
+    '''
+    gids = array.array('i')
+    if hasattr(gids, 'frombytes'):
+        gids.frombytes(data)
+    else:
+        gids.fromstring(data)
+    if sys.byteorder != 'little':
+        gids.byteswap()
+    return gids
+
+
 class LayerIterator(object):
     '''Iterates over all the cells in a layer in column,row order.
     '''
@@ -204,15 +1371,48 @@ class Layer(object):
         tilesets - the tilesets used in this Layer (a Tilesets instance)
         properties - any properties set for this Layer
         cells - a dict of all the Cell instances for this Layer, keyed off
-                (x, y) index.
+                (x, y) index; a CellGrid for compact layers or a RegionGrid
+                for streamed ones
+        index - a PropertyIndex of the cells' properties
+        compact - whether the cells are stored as a CellGrid
+        streamed - whether the cells are stored as a RegionGrid, which only
+                   reads the regions around the viewport out of the
+                   layer's compressed data
+        infinite - whether the layer is read from the chunks of a Tiled
+                   infinite map; its cells are stored in a ChunkGrid and
+                   may lie anywhere, including at negative indexes,
+                   regardless of width and height
+        chunked - whether the layer is drawn from pre-baked chunks of
+                  chunk_size by chunk_size tiles (see draw())
 
     Additionally you may look up a cell using direct item access:
 
        layer[x, y] is layer.cells[x, y]
 
     Note that empty cells will be set to None instead of a Cell instance.
+
+    Compact layers create Cells only as they are looked up, so two lookups of
+    the same cell only return the same Cell once a property has been set or
+    deleted on it. Layers of at least compact_threshold cells are compact
+    unless asked otherwise.
+
+    Cells should be set through item assignment so the property index and
+    the render cache stay current. If the cells dict is changed directly call
+    reindex() and invalidate() afterwards.
     '''
-    def __init__(self, name, visible, map):
+    # the width and height, in tiles, of the blocks baked by the render cache
+    chunk_size = 8
+    # the most memory, in bytes, the render cache may hold before chunks far
+    # from the viewport are evicted
+    chunk_budget = 16 * 1024 * 1024
+    # the number of cells from which layers are compact by default
+    compact_threshold = 256 * 256
+    # the width and height, in tiles, of the regions of streamed layers and
+    # the most memory, in bytes, their decompressed regions may hold
+    region_size = 32
+    region_budget = 4 * 1024 * 1024
+
+    def __init__(self, name, visible, map, compact=None, streamed=False):
         self.name = name
         self.visible = visible
         self.position = (0, 0)
@@ -226,7 +1426,28 @@ class Layer(object):
         self.tilesets = map.tilesets
         self.group = pygame.sprite.Group()
         self.properties = {}
-        self.cells = {}
+        if compact is None:
+            compact = self.width * self.height >= self.compact_threshold
+        self.compact = compact or streamed
+        self.streamed = streamed
+        self.infinite = False
+        if streamed:
+            self.cells = RegionGrid(self, None, self.region_size,
+                self.region_budget)
+            self.index = RegionPropertyIndex(self.cells)
+        elif compact:
+            self.cells = CellGrid(self)
+            self.index = GridPropertyIndex(self.cells)
+        else:
+            self.cells = {}
+            self.index = PropertyIndex()
+        self.chunked = True
+        # baked chunk Surfaces (or None for empty chunks) keyed off chunk
+        # (column, row) index
+        self._chunks = {}
+        self._chunk_bytes = 0
+        # cell indexes changed since the last draw (None meaning all of them)
+        self._changed = []
 
     def __repr__(self):
         return '<Layer "%s" at 0x%x>' % (self.name, id(self))
@@ -238,31 +1459,168 @@ class Layer(object):
         x, y = pos
         px = x * self.tile_width
         py = y * self.tile_width
-        self.cells[pos] = Cell(x, y, px, py, tile)
+        old = self.cells.get(pos)
+        if old is not None:
+            self.index.remove(old)
+            old._layer = None
+        cell = self.cells[pos] = Cell(x, y, px, py, tile)
+        cell._layer = self
+        self.index.add(cell)
+        self.invalidate(pos)
+
+    def invalidate(self, pos=None):
+        '''Discard the baked chunk holding the cell index pos, or all baked
+        chunks if pos is None.
+        '''
+        if pos is None:
+            self._chunks.clear()
+            self._chunk_bytes = 0
+            self._changed = None
+            return
+        if self._changed is not None:
+            self._changed.append(pos)
+        x, y = pos
+        self._drop_chunk((x // self.chunk_size, y // self.chunk_size))
+
+    def dirty_rects(self):
+        '''Return the screen-space Rects which have changed since this layer
+        was last drawn.
+        '''
+        ox, oy = self.position
+        if self._changed is None:
+            return [Rect(0, 0, self.view_w, self.view_h)]
+        rects = []
+        for pos in self._changed:
+            cell = self.cells.get(pos)
+            if cell is None:
+                x, y = pos
+                rects.append(Rect(x * self.tile_width - ox,
+                    y * self.tile_height - oy, self.tile_width,
+                    self.tile_height))
+            else:
+                rects.append(Rect(cell.px - ox, cell.py - oy,
+                    cell.tile.tile_width, cell.tile.tile_height))
+        return rects
+
+    def _drop_chunk(self, key):
+        chunk = self._chunks.pop(key, None)
+        if chunk is not None:
+            w, h = chunk.get_size()
+            self._chunk_bytes -= w * h * chunk.get_bytesize()
+
+    def reindex(self):
+        '''Rebuild the property index from the cells dict.
+        '''
+        self.index.clear()
+        if self.compact:
+            return
+        for pos in sorted(self.cells):
+            cell = self.cells[pos]
+            cell._layer = self
+            self.index.add(cell)
+
+    def _property_changing(self, cell, key):
+        self.index.remove_property(cell, key)
+
+    def _property_changed(self, cell, key):
+        self.index.add_property(cell, key)
 
     def __iter__(self):
         return LayerIterator(self)
 
     @classmethod
-    def fromxml(cls, tag, map):
-        layer = cls(tag.attrib['name'], int(tag.attrib.get('visible', 1)), map)
+    def fromxml(cls, tag, map, compact=None, streamed=False):
+        layer = cls(tag.attrib['name'], int(tag.attrib.get('visible', 1)), map,
+            compact, streamed)
 
         data = tag.find('data')
         if data is None:
             raise ValueError('layer %s does not contain <data>' % layer.name)
 
-        data = data.text.strip()
-        data = data.decode('base64').decode('zlib')
-        data = struct.unpack('<%di' % (len(data)/4,), data)
-        assert len(data) == layer.width * layer.height
-        for i, gid in enumerate(data):
+        encoding = data.attrib.get('encoding')
+        compression = data.attrib.get('compression')
+        chunks = data.findall('chunk')
+        if chunks:
+            layer.set_chunks([(int(chunk.attrib['x']), int(chunk.attrib['y']),
+                int(chunk.attrib['width']), int(chunk.attrib['height']),
+                chunk.text) for chunk in chunks], encoding, compression)
+            return layer
+
+        if layer.streamed and encoding == 'base64' and compression in ('zlib',
+                'gzip'):
+            # keep the data compressed, decompressing it only as it's read
+            wbits = zlib.MAX_WBITS
+            if compression == 'gzip':
+                wbits += 16
+            layer.set_source(InflateSource(base64.b64decode(data.text.strip()),
+                wbits))
+            return layer
+
+        data = decode_data(data.text, encoding, compression)
+        if len(data) != layer.width * layer.height:
+            raise ValueError('layer %s holds %d tiles, not %dx%d' % (layer.name,
+                len(data), layer.width, layer.height))
+        layer.set_gids(data, map)
+        return layer
+
+    def set_chunks(self, chunks, encoding='base64', compression='zlib'):
+        '''Make this an infinite layer holding the chunks given, a sequence
+        of (x, y, width, height, text) with the text of each chunk's TMX
+        <chunk> element. The chunks are only decoded as they're used.
+        '''
+        width, height = chunks[0][2:4] if chunks else (16, 16)
+        self.cells = ChunkGrid(self, width, height, encoding, compression)
+        for x, y, w, h, text in chunks:
+            self.cells.add_chunk(x, y, w, h, text)
+        self.index = RegionPropertyIndex(self.cells)
+        self.infinite = True
+        self.compact = True
+        self.streamed = False
+        self.invalidate()
+
+    def set_gids(self, gids, map):
+        '''Fill this layer from a row-major sequence of width * height
+        global tile ids (0 meaning no tile).
+        '''
+        if self.streamed:
+            self.set_source(ArraySource(gids))
+            return
+        if self.compact:
+            if not isinstance(gids, array.array):
+                gids = array.array('i', gids)
+            self.cells = CellGrid(self, gids)
+            self.index = GridPropertyIndex(self.cells)
+            self.invalidate()
+            return
+        for i, gid in enumerate(gids):
             if gid < 1: continue   # not set
             tile = map.tilesets[gid]
-            x = i % layer.width
-            y = i // layer.width
-            layer.cells[x,y] = Cell(x, y, x*map.tile_width, y*map.tile_height, tile)
-
-        return layer
+            x = i % self.width
+            y = i // self.width
+            self.cells[x,y] = Cell(x, y, x*map.tile_width, y*map.tile_height, tile)
+        self.reindex()
+        self.invalidate()
+
+    def set_source(self, source):
+        '''Fill this streamed layer from source, an ArraySource, BufferSource
+        or InflateSource of its row-major global tile ids, which are only
+        read as the regions holding them are needed (see RegionGrid.)
+        '''
+        self.cells = RegionGrid(self, source, self.region_size,
+            self.region_budget)
+        self.index = RegionPropertyIndex(self.cells)
+        self.invalidate()
+
+    def gids(self):
+        '''Return the layer's global tile ids as a row-major array; for
+        infinite layers, those within the bounds of the chunks.
+        '''
+        if self.compact:
+            return array.array('i', self.cells.gids)
+        gids = array.array('i', [0]) * (self.width * self.height)
+        for (x, y), cell in self.cells.items():
+            gids[y * self.width + x] = cell.tile.gid
+        return gids
 
     def update(self, dt, *args):
         pass
@@ -270,15 +1628,102 @@ class Layer(object):
     def set_view(self, x, y, w, h, viewport_ox=0, viewport_oy=0):
         self.view_x, self.view_y = x, y
         self.view_w, self.view_h = w, h
+        if self.streamed:
+            self.cells.focus(x, y, w, h)
         x -= viewport_ox
         y -= viewport_oy
         self.position = (x, y)
 
     def draw(self, surface):
         '''Draw this layer, limited to the current viewport, to the Surface.
+
+        If the layer is chunked, blocks of chunk_size by chunk_size tiles are
+        baked into off-screen Surfaces the first time they're seen and only
+        the chunks overlapping the viewport are drawn.
+        '''
+        self._changed = []
+        if not self.chunked:
+            self.draw_tiles(surface)
+            return
+        ox, oy = self.position
+        w, h = self.view_w, self.view_h
+        cw = self.chunk_size * self.tile_width
+        ch = self.chunk_size * self.tile_height
+        chunks = self._chunks
+        blits = []
+        for i in range(ox // cw, (ox + w) // cw + 1):
+            for j in range(oy // ch, (oy + h) // ch + 1):
+                if (i, j) in chunks:
+                    chunk = chunks[i, j]
+                else:
+                    chunk = self._bake_chunk(i, j)
+                    if not self.chunked:
+                        # the layer can't be chunked after all
+                        self.draw_tiles(surface)
+                        return
+                if chunk is not None:
+                    blits.append((chunk, (i * cw - ox, j * ch - oy)))
+        blit_all(surface, blits)
+        if self._chunk_bytes > self.chunk_budget:
+            self._evict_chunks()
+
+    def _bake_chunk(self, i, j):
+        '''Render the tiles of chunk (i, j) into a new Surface and cache it.
+
+        Return the Surface, or None if the chunk has no tiles.
+        '''
+        size = self.chunk_size
+        cx, cy = i * size * self.tile_width, j * size * self.tile_height
+        cells = []
+        for x in range(i * size, (i + 1) * size):
+            for y in range(j * size, (j + 1) * size):
+                cell = self.cells.get((x, y))
+                if cell is None:
+                    continue
+                if (cell.tile.tile_width > self.tile_width or
+                        cell.tile.tile_height > self.tile_height):
+                    # oversized tiles would be clipped at the chunk edges
+                    self.chunked = False
+                    self.invalidate()
+                    return None
+                cells.append(cell)
+        if not cells:
+            self._chunks[i, j] = None
+            return None
+        chunk = pygame.Surface((size * self.tile_width,
+            size * self.tile_height), pygame.SRCALPHA, 32)
+        if pygame.display.get_surface() is not None:
+            chunk = chunk.convert_alpha()
+        for cell in cells:
+            chunk.blit(cell.tile.surface, (cell.px - cx, cell.py - cy))
+        self._chunks[i, j] = chunk
+        self._chunk_bytes += chunk.get_width() * chunk.get_height() * \
+            chunk.get_bytesize()
+        return chunk
+
+    def _evict_chunks(self):
+        '''Drop the chunks furthest from the viewport until the render cache
+        is back within its memory budget.
+        '''
+        ox, oy = self.position
+        cw = self.chunk_size * self.tile_width
+        ch = self.chunk_size * self.tile_height
+        ci = (ox + self.view_w // 2) // cw
+        cj = (oy + self.view_h // 2) // ch
+        def distance(key):
+            return max(abs(key[0] - ci), abs(key[1] - cj))
+        for key in sorted(self._chunks, key=distance, reverse=True):
+            if self._chunk_bytes <= self.chunk_budget:
+                break
+            self._drop_chunk(key)
+
+    def draw_tiles(self, surface):
+        '''Draw this layer tile by tile, limited to the current viewport, to
+        the Surface.
         '''
         ox, oy = self.position
         w, h = self.view_w, self.view_h
+        blits = []
         for x in range(ox, ox + w + self.tile_width, self.tile_width):
             i = x // self.tile_width
             for y in range(oy, oy + h + self.tile_height, self.tile_height):
@@ -286,16 +1731,15 @@ class Layer(object):
                 if (i, j) not in self.cells:
                     continue
                 cell = self.cells[i, j]
-                surface.blit(cell.tile.surface, (cell.px - ox, cell.py - oy))
+                blits.append((cell.tile.surface, (cell.px - ox, cell.py - oy)))
+        blit_all(surface, blits)
 
     def find(self, *properties):
         '''Find all cells with the given properties set.
         '''
         r = []
         for propname in properties:
-            for cell in self.cells.values():
-                if cell and propname in cell:
-                    r.append(cell)
+            r.extend(self.index.having(propname))
         return r
 
     def match(self, **properties):
@@ -303,23 +1747,19 @@ class Layer(object):
         '''
         r = []
         for propname in properties:
-            for cell in self.cells.values():
-                if propname not in cell:
-                    continue
-                if properties[propname] == cell[propname]:
-                    r.append(cell)
+            r.extend(self.index.matching(propname, properties[propname]))
         return r
 
     def collide(self, rect, propname):
         '''Find all cells the rect is touching that have the indicated property
         name set.
         '''
+        if not self.index.has_property(propname):
+            return []
         r = []
         for cell in self.get_in_region(rect.left, rect.top, rect.right,
                 rect.bottom):
-            if not cell.intersects(rect):
-                continue
-            if propname in cell:
+            if cell.intersects(rect) and propname in cell:
                 r.append(cell)
         return r
 
@@ -330,10 +1770,13 @@ class Layer(object):
 
         Return a list of Cell instances.
         '''
-        i1 = max(0, x1 // self.tile_width)
-        j1 = max(0, y1 // self.tile_height)
-        i2 = min(self.width, x2 // self.tile_width + 1)
-        j2 = min(self.height, y2 // self.tile_height + 1)
+        i1 = x1 // self.tile_width
+        j1 = y1 // self.tile_height
+        i2 = x2 // self.tile_width + 1
+        j2 = y2 // self.tile_height + 1
+        if not self.infinite:
+            i1, j1 = max(0, i1), max(0, j1)
+            i2, j2 = min(self.width, i2), min(self.height, j2)
         return [self.cells[i, j]
             for i in range(int(i1), int(i2))
                 for j in range(int(j1), int(j2))
@@ -355,6 +1798,8 @@ class Layer(object):
         Returns a list of 2-tuple indexes.
         '''
         i, j = index
+        if self.infinite:
+            return [(i + 1, j), (i - 1, j), (i, j + 1), (i, j - 1)]
         n = []
         if i < self.width - 1:
             n.append((i + 1, j))
@@ -378,6 +1823,10 @@ height: The height of the object in pixels (defaults to 0).
 gid: An reference to a tile (optional).
 visible: Whether the object is shown (1) or hidden (0). Defaults to 1.
     '''
+    __slots__ = ('type', 'px', 'left', 'py', 'top', 'width', 'right', 'height',
+        'bottom', 'name', 'gid', 'tile', 'visible', 'properties',
+        '_added_properties', '_deleted_properties', '_layer')
+
     def __init__(self, type, x, y, width=0, height=0, name=None,
             gid=None, tile=None, visible=1):
         self.type = type
@@ -399,8 +1848,11 @@ visible: Whether the object is shown (1) or hidden (0). Defaults to 1.
         self.visible = visible
         self.properties = {}
 
-        self._added_properties = {}
-        self._deleted_properties = set()
+        # the added and deleted property overrides, created when first needed
+        self._added_properties = None
+        self._deleted_properties = None
+        # the ObjectLayer indexing this object's properties, if any
+        self._layer = None
 
     def __repr__(self):
         if self.tile:
@@ -409,18 +1861,18 @@ visible: Whether the object is shown (1) or hidden (0). Defaults to 1.
             return '<Object %s,%s %s,%s>' % (self.px, self.py, self.width, self.height)
 
     def __contains__(self, key):
-        if key in self._deleted_properties:
+        if self._deleted_properties and key in self._deleted_properties:
             return False
-        if key in self._added_properties:
+        if self._added_properties and key in self._added_properties:
             return True
         if key in self.properties:
             return True
         return self.tile and key in self.tile.properties
 
     def __getitem__(self, key):
-        if key in self._deleted_properties:
+        if self._deleted_properties and key in self._deleted_properties:
             raise KeyError(key)
-        if key in self._added_properties:
+        if self._added_properties and key in self._added_properties:
             return self._added_properties[key]
         if key in self.properties:
             return self.properties[key]
@@ -429,10 +1881,34 @@ visible: Whether the object is shown (1) or hidden (0). Defaults to 1.
         raise KeyError(key)
 
     def __setitem__(self, key, value):
+        if self._layer is not None:
+            self._layer._property_changing(self, key)
+        if self._added_properties is None:
+            self._added_properties = {}
         self._added_properties[key] = value
+        if self._layer is not None:
+            self._layer._property_changed(self, key)
 
     def __delitem__(self, key):
+        if self._layer is not None:
+            self._layer._property_changing(self, key)
+        if self._deleted_properties is None:
+            self._deleted_properties = set()
         self._deleted_properties.add(key)
+        if self._layer is not None:
+            self._layer._property_changed(self, key)
+
+    def keys(self):
+        '''Return the names of all the properties set on this object.
+        '''
+        keys = set(self.properties)
+        if self._added_properties:
+            keys.update(self._added_properties)
+        if self.tile:
+            keys.update(self.tile.properties)
+        if self._deleted_properties:
+            keys.difference_update(self._deleted_properties)
+        return list(keys)
 
     def draw(self, surface, view_x, view_y):
         if not self.visible:
@@ -487,6 +1963,115 @@ visible: Whether the object is shown (1) or hidden (0). Defaults to 1.
             return False
         return True
 
+    def contains(self, x, y):
+        '''Determine whether the (x, y) pixel lies within this Object's
+        bounds (edges included, as with intersects()).
+        '''
+        return (self.px <= x <= self.px + self.width and
+            self.py <= y <= self.py + self.height)
+
+
+class ObjectGrid(object):
+    '''A uniform bucket grid over the Objects in an ObjectLayer.
+
+    Each object is recorded in every bucket its bounds touch, so a region
+    query only has to look at the objects in the buckets it overlaps rather
+    than every object in the layer. Results are returned in the order the
+    objects were added, which matches the order of the layer's object list.
+
+    Objects are assumed not to move once added; if one does, remove() it
+    before changing its position and add() it again afterwards.
+    '''
+    def __init__(self, bucket_size=128):
+        self.bucket_size = bucket_size
+        self.buckets = {}
+        # object -> (insertion serial, bucket span)
+        self.entries = {}
+        self._serial = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, obj):
+        return obj in self.entries
+
+    def span(self, x1, y1, x2, y2):
+        '''Return the (i1, j1, i2, j2) inclusive range of bucket indexes
+        touched by the pixel bounds given.
+        '''
+        s = self.bucket_size
+        return int(x1 // s), int(y1 // s), int(x2 // s), int(y2 // s)
+
+    def add(self, obj):
+        span = self.span(obj.px, obj.py, obj.px + obj.width,
+            obj.py + obj.height)
+        self.entries[obj] = (self._serial, span)
+        self._serial += 1
+        i1, j1, i2, j2 = span
+        for i in range(i1, i2 + 1):
+            for j in range(j1, j2 + 1):
+                bucket = self.buckets.get((i, j))
+                if bucket is None:
+                    self.buckets[i, j] = [obj]
+                else:
+                    bucket.append(obj)
+
+    def remove(self, obj):
+        serial, (i1, j1, i2, j2) = self.entries.pop(obj)
+        for i in range(i1, i2 + 1):
+            for j in range(j1, j2 + 1):
+                bucket = self.buckets[i, j]
+                bucket.remove(obj)
+                if not bucket:
+                    del self.buckets[i, j]
+
+    def clear(self):
+        self.buckets.clear()
+        self.entries.clear()
+
+    def query(self, x1, y1, x2, y2):
+        '''Return the objects intersecting the pixel bounds given, in the
+        order they were added.
+        '''
+        i1, j1, i2, j2 = self.span(x1, y1, x2, y2)
+        if i1 == i2 and j1 == j2:
+            # the common case for sprite-sized queries; a single bucket is
+            # already in insertion order
+            bucket = self.buckets.get((i1, j1))
+            if not bucket:
+                return []
+            return [obj for obj in bucket if obj.intersects(x1, y1, x2, y2)]
+
+        if (i2 - i1 + 1) * (j2 - j1 + 1) > len(self.entries):
+            # the region covers more buckets than there are objects so just
+            # test them all
+            found = [obj for obj in self.entries
+                if obj.intersects(x1, y1, x2, y2)]
+        else:
+            seen = set()
+            found = []
+            for i in range(i1, i2 + 1):
+                for j in range(j1, j2 + 1):
+                    for obj in self.buckets.get((i, j), ()):
+                        if obj in seen:
+                            continue
+                        seen.add(obj)
+                        if obj.intersects(x1, y1, x2, y2):
+                            found.append(obj)
+        entries = self.entries
+        found.sort(key=lambda obj: entries[obj][0])
+        return found
+
+    def query_point(self, x, y):
+        '''Return the first object (in insertion order) containing the
+        pixel (x, y), or None.
+        '''
+        s = self.bucket_size
+        for obj in self.buckets.get((int(x // s), int(y // s)), ()):
+            if obj.contains(x, y):
+                return obj
+        return None
+
 
 class ObjectLayer(object):
     '''A layer composed of basic primitive shapes.
@@ -502,7 +2087,16 @@ class ObjectLayer(object):
         opacity - the opacity of the layer as a value from 0 to 1.
         visible - whether the layer is shown (1) or hidden (0).
         objects - the objects in this Layer (Object instances)
+        grid - an ObjectGrid spatial index over the objects
+        index - a PropertyIndex of the objects' properties
+
+    Objects should be added and removed with add() and remove() so the
+    indexes stay current. If the objects list is changed directly call
+    reindex() afterwards.
     '''
+    # size in pixels of the spatial index buckets
+    bucket_size = 128
+
     def __init__(self, name, color, objects, opacity=1,
             visible=1, position=(0, 0)):
         self.name = name
@@ -512,17 +2106,23 @@ class ObjectLayer(object):
         self.visible = visible
         self.position = position
         self.properties = {}
+        self.grid = ObjectGrid(self.bucket_size)
+        self.index = PropertyIndex()
+        # ObjectGrids of just the objects with a given property, built on
+        # demand by collide()
+        self._property_grids = {}
+        self.reindex()
 
     def __repr__(self):
         return '<ObjectLayer "%s" at 0x%x>' % (self.name, id(self))
 
     @classmethod
     def fromxml(cls, tag, map):
-        layer = cls(tag.attrib['name'], tag.attrib.get('color'), [],
+        objects = [Object.fromxml(object, map)
+            for object in tag.findall('object')]
+        layer = cls(tag.attrib['name'], tag.attrib.get('color'), objects,
             float(tag.attrib.get('opacity', 1)),
             int(tag.attrib.get('visible', 1)))
-        for object in tag.findall('object'):
-            layer.objects.append(Object.fromxml(object, map))
         for c in tag.findall('property'):
             # store additional properties.
             name = c.attrib['name']
@@ -534,6 +2134,62 @@ class ObjectLayer(object):
             layer.properties[name] = value
         return layer
 
+    def add(self, object):
+        '''Add the Object to this layer and its indexes.
+        '''
+        self.objects.append(object)
+        self._index_object(object)
+
+    def remove(self, object):
+        '''Remove the Object from this layer and its indexes.
+        '''
+        self.objects.remove(object)
+        self.grid.remove(object)
+        for key in object.keys():
+            grid = self._property_grids.get(key)
+            if grid is not None:
+                grid.remove(object)
+        self.index.remove(object)
+        object._layer = None
+
+    def reindex(self):
+        '''Rebuild the spatial and property indexes from the objects list.
+        '''
+        self.grid.clear()
+        self.index.clear()
+        self._property_grids.clear()
+        for object in self.objects:
+            self._index_object(object)
+
+    def _index_object(self, object):
+        object._layer = self
+        self.grid.add(object)
+        self.index.add(object)
+        for key in object.keys():
+            grid = self._property_grids.get(key)
+            if grid is not None:
+                grid.add(object)
+
+    def _property_changing(self, object, key):
+        self.index.remove_property(object, key)
+        # the per-property grid is rebuilt on demand to keep layer order
+        self._property_grids.pop(key, None)
+
+    def _property_changed(self, object, key):
+        self.index.add_property(object, key)
+
+    def _property_grid(self, propname):
+        grid = self._property_grids.get(propname)
+        if grid is None:
+            objects = self.index.having(propname)
+            if not objects:
+                return None
+            grid = ObjectGrid(self.bucket_size)
+            for object in objects:
+                grid.add(object)
+            self._property_grids[propname] = grid
+        return grid
+
     def update(self, dt, *args):
         pass
 
@@ -544,6 +2200,12 @@ class ObjectLayer(object):
         y -= viewport_oy
         self.position = (x, y)
 
+    def dirty_rects(self):
+        '''Return the screen-space Rects which have changed since this layer
+        was last drawn; objects don't move so there are none.
+        '''
+        return []
+
     def draw(self, surface):
         '''Draw this layer, limited to the current viewport, to the Surface.
         '''
@@ -559,9 +2221,10 @@ class ObjectLayer(object):
         '''
         r = []
         for propname in properties:
-            for object in self.objects:
-                if object and propname in object or propname in self.properties:
-                    r.append(object)
+            if propname in self.properties:
+                r.extend(self.objects)
+            else:
+                r.extend(self.index.having(propname))
         return r
 
     def match(self, **properties):
@@ -569,6 +2232,10 @@ class ObjectLayer(object):
         '''
         r = []
         for propname in properties:
+            if propname not in self.properties:
+                r.extend(self.index.matching(propname, properties[propname]))
+                continue
+            # objects without the property inherit the layer's value
             for object in self.objects:
                 if propname in object:
                     val = object[propname]
@@ -584,12 +2251,13 @@ class ObjectLayer(object):
         '''Find all objects the rect is touching that have the indicated
         property name set.
         '''
-        r = []
-        for object in self.get_in_region(rect.left, rect.top, rect.right,
-                rect.bottom):
-            if propname in object or propname in self.properties:
-                r.append(object)
-        return r
+        if propname in self.properties:
+            grid = self.grid
+        else:
+            grid = self._property_grid(propname)
+            if grid is None:
+                return []
+        return grid.query(rect.left, rect.top, rect.right, rect.bottom)
 
     def get_in_region(self, x1, y1, x2, y2):
         '''Return objects that are within the map-space
@@ -598,22 +2266,243 @@ class ObjectLayer(object):
 
         Return a list of Object instances.
         '''
-        return [obj for obj in self.objects if obj.intersects(x1, y1, x2, y2)]
+        return self.grid.query(x1, y1, x2, y2)
 
     def get_at(self, x, y):
         '''Return the first object found at the nominated (x, y) coordinate.
 
         Return an Object instance or None.
         '''
-        for object in self.objects:
-            if object.contains(x,y):
-                return object
+        return self.grid.query_point(x, y)
+
+
+class SpriteGrid(object):
+    '''A uniform bucket grid over the sprites in a SpriteLayer.
+
+    Unlike the objects in an ObjectGrid sprites move, so the buckets each
+    sprite was put in are remembered and move() rebuckets a sprite only when
+    its rect has crossed into different ones. A sprite is added to its groups
+    before its constructor gets to set its rect, so sprites without a rect
+    are held back and bucketed on the next query or move().
+    '''
+    def __init__(self, bucket_size=64):
+        self.bucket_size = bucket_size
+        self.buckets = {}
+        # sprite -> (insertion serial, bucket span or None if not bucketed)
+        self.entries = {}
+        self._pending = []
+        self._serial = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, sprite):
+        return sprite in self.entries
+
+    def span(self, rect):
+        '''Return the (i1, j1, i2, j2) inclusive range of bucket indexes
+        touched by the rect.
+        '''
+        s = self.bucket_size
+        return (int(rect.left // s), int(rect.top // s),
+            int(rect.right // s), int(rect.bottom // s))
+
+    def add(self, sprite):
+        self.entries[sprite] = (self._serial, None)
+        self._serial += 1
+        if getattr(sprite, 'rect', None) is None:
+            self._pending.append(sprite)
+        else:
+            self.move(sprite)
+
+    def remove(self, sprite):
+        serial, span = self.entries.pop(sprite)
+        if span is not None:
+            self._unbucket(sprite, span)
+
+    def clear(self):
+        self.buckets.clear()
+        self.entries.clear()
+        del self._pending[:]
+
+    def move(self, sprite):
+        '''Rebucket the sprite if its rect has moved into different buckets
+        since it was last bucketed.
+        '''
+        entry = self.entries.get(sprite)
+        if entry is None:
+            return
+        serial, span = entry
+        new = self.span(sprite.rect)
+        if new == span:
+            return
+        if span is not None:
+            self._unbucket(sprite, span)
+        i1, j1, i2, j2 = new
+        for i in range(i1, i2 + 1):
+            for j in range(j1, j2 + 1):
+                bucket = self.buckets.get((i, j))
+                if bucket is None:
+                    self.buckets[i, j] = [sprite]
+                else:
+                    bucket.append(sprite)
+        self.entries[sprite] = (serial, new)
+
+    def _unbucket(self, sprite, span):
+        i1, j1, i2, j2 = span
+        for i in range(i1, i2 + 1):
+            for j in range(j1, j2 + 1):
+                bucket = self.buckets[i, j]
+                bucket.remove(sprite)
+                if not bucket:
+                    del self.buckets[i, j]
+
+    def _flush(self):
+        pending = self._pending
+        while pending:
+            sprite = pending.pop()
+            if getattr(sprite, 'rect', None) is not None:
+                self.move(sprite)
+
+    def query(self, rect):
+        '''Return the sprites whose rects collide with the rect, in the order
+        they were added.
+        '''
+        if self._pending:
+            self._flush()
+        i1, j1, i2, j2 = self.span(rect)
+        if i1 == i2 and j1 == j2:
+            bucket = self.buckets.get((i1, j1))
+            if not bucket:
+                return []
+            found = [sprite for sprite in bucket
+                if rect.colliderect(sprite.rect)]
+            if len(found) < 2:
+                return found
+        else:
+            seen = set()
+            found = []
+            for i in range(i1, i2 + 1):
+                for j in range(j1, j2 + 1):
+                    for sprite in self.buckets.get((i, j), ()):
+                        if sprite in seen:
+                            continue
+                        seen.add(sprite)
+                        if rect.colliderect(sprite.rect):
+                            found.append(sprite)
+        entries = self.entries
+        found.sort(key=lambda sprite: entries[sprite][0])
+        return found
 
 
 class SpriteLayer(pygame.sprite.AbstractGroup):
+    '''A layer of pygame sprites drawn in map coordinates.
+
+    SpriteLayers keep a SpriteGrid over their sprites so collision queries
+    only look at the sprites near the area asked about. The grid follows
+    sprites moved by their update(); a sprite moved any other way must be
+    passed to moved() before the layer is queried again.
+
+    Only sprites in or near the viewport are drawn. If activity_margin is
+    set only the sprites within that many pixels of the viewport are
+    updated; the rest sleep until the viewport comes near them again. A
+    sprite with sleep() or wake() methods has them called as it leaves or
+    enters the activity region.
+    '''
+    # the size in pixels of the grid buckets sprites are kept in
+    bucket_size = 64
+    # sprites are drawn if their rect is within this many pixels of the
+    # viewport, allowing for images drawn a little away from their rect
+    # (eg. by interpolation between updates)
+    draw_margin = 64
+    # how far beyond the viewport, in pixels, sprites are kept awake; None
+    # updates every sprite however far away
+    activity_margin = None
+
     def __init__(self):
         super(SpriteLayer, self).__init__()
         self.visible = True
+        # the screen Rect and image of each sprite as it was last drawn
+        self._drawn = {}
+        self.grid = SpriteGrid(self.bucket_size)
+        # the sprites in the activity region as of the last update
+        self._awake = set()
+
+    def add_internal(self, sprite, *args):
+        super(SpriteLayer, self).add_internal(sprite, *args)
+        self.grid.add(sprite)
+
+    def remove_internal(self, sprite, *args):
+        super(SpriteLayer, self).remove_internal(sprite, *args)
+        self.grid.remove(sprite)
+
+    def update(self, *args):
+        move = self.grid.move
+        for sprite in self.active():
+            sprite.update(*args)
+            move(sprite)
+
+    def region(self, margin):
+        '''Return the map-space Rect of the viewport grown by margin pixels
+        on each side, or None if the view hasn't been set yet.
+        '''
+        if not hasattr(self, 'view_x'):
+            return None
+        return Rect(self.view_x - margin, self.view_y - margin,
+            self.view_w + 2 * margin, self.view_h + 2 * margin)
+
+    def active(self):
+        '''Return the sprites to update: those in the activity region, or
+        all of them if there's no activity margin. Sprites entering the
+        region are woken and those leaving it are put to sleep.
+        '''
+        if self.activity_margin is None:
+            return self.sprites()
+        region = self.region(self.activity_margin)
+        if region is None:
+            return self.sprites()
+        awake = self.grid.query(region)
+        now, before = set(awake), self._awake
+        for sprite in before - now:
+            if sprite in self.spritedict and hasattr(sprite, 'sleep'):
+                sprite.sleep()
+        for sprite in awake:
+            if sprite not in before and hasattr(sprite, 'wake'):
+                sprite.wake()
+        self._awake = now
+        return awake
+
+    def visible_sprites(self):
+        '''Return the sprites near enough to the viewport to be drawn.
+        '''
+        return self.grid.query(self.region(self.draw_margin))
+
+    def moved(self, sprite):
+        '''Tell the layer the sprite has moved outside of update().
+        '''
+        self.grid.move(sprite)
+
+    def collide(self, rect):
+        '''Find the sprites whose rects collide with the rect.
+        '''
+        return self.grid.query(rect)
+
+    def spritecollide(self, sprite, dokill=False):
+        '''Find the sprites colliding with the sprite, as
+        pygame.sprite.spritecollide() does; if dokill is true they're
+        removed from all their groups.
+        '''
+        found = self.grid.query(sprite.rect)
+        if dokill:
+            for other in found:
+                other.kill()
+        return found
+
+    def get_in_region(self, x1, y1, x2, y2):
+        '''Return the sprites within the map-space pixel bounds specified by
+        the top-left (x1, y1) and bottom-right (x2, y2) corners.
+        '''
+        return self.grid.query(Rect(x1, y1, x2 - x1, y2 - y1))
 
     def set_view(self, x, y, w, h, viewport_ox=0, viewport_oy=0):
         self.view_x, self.view_y = x, y
@@ -622,12 +2511,43 @@ class SpriteLayer(pygame.sprite.AbstractGroup):
         y -= viewport_oy
         self.position = (x, y)
 
+    def dirty_rects(self):
+        '''Return the screen-space Rects which have changed since this layer
+        was last drawn: where sprites that moved, changed image, were added
+        or were removed were and now are.
+        '''
+        ox, oy = self.position
+        drawn = self._drawn
+        rects = []
+        visible = self.visible_sprites()
+        for sprite in visible:
+            sx, sy = sprite.rect.topleft
+            rect = Rect((sx-ox, sy-oy), sprite.image.get_size())
+            last = drawn.get(sprite)
+            if last is None:
+                rects.append(rect)
+            elif last[1] is not sprite.image or last[0] != rect:
+                rects.append(last[0])
+                rects.append(rect)
+        # sprites which were drawn but are now gone or out of view
+        visible = set(visible)
+        for sprite in drawn:
+            if sprite not in visible:
+                rects.append(drawn[sprite][0])
+        return rects
+
     def draw(self, screen):
         ox, oy = self.position
-        w, h = self.view_w, self.view_h
-        for sprite in self.sprites():
+        drawn = {}
+        blits = []
+        for sprite in self.visible_sprites():
             sx, sy = sprite.rect.topleft
-            screen.blit(sprite.image, (sx-ox, sy-oy))
+            image = sprite.image
+            rect = Rect((sx-ox, sy-oy), image.get_size())
+            blits.append((image, rect))
+            drawn[sprite] = (rect, image)
+        blit_all(screen, blits)
+        self._drawn = drawn
 
 class Layers(list):
     def __init__(self):
@@ -660,6 +2580,11 @@ class TileMap(object):
         width, height - the dimensions of the tilemap in cells
         tile_width, tile_height - the dimensions of the cells in the map
         px_width, px_height - the dimensions of the tilemap in pixels
+        px_left, px_top - the map-space pixel position of the tilemap's
+                          top-left corner; negative if an infinite map
+                          extends left of or above its origin
+        infinite - whether the map is a Tiled infinite map, whose bounds
+                   are those of its tile layers' chunks
         properties - any properties set on the tilemap in the TMX file
         layers - all layers of this tilemap as a Layers instance
         tilesets - all tilesets of this tilemap as a Tilesets instance
@@ -676,6 +2601,9 @@ class TileMap(object):
         self.tile_height = 0
         self.width = 0
         self.height  = 0
+        self.px_left = 0
+        self.px_top = 0
+        self.infinite = False
         self.properties = {}
         self.layers = Layers()
         self.tilesets = Tilesets()
@@ -694,31 +2622,134 @@ class TileMap(object):
                 layer.draw(screen)
 
     @classmethod
-    def load(cls, filename, viewport):
-        with open(filename) as f:
-            map = ElementTree.fromstring(f.read())
+    def load(cls, filename, viewport, cache=True, compact=None, stream=False,
+            load_image=load_image):
+        '''Load the TMX file, loading the images of its tilesets with
+        load_image(file). Tilesets from .tsx files which another map holds
+        already are shared (see TilesetRegistry) however they were loaded.
+
+        If cache is true a compiled copy of the map is kept alongside the
+        file (see compiled_filename()) and used instead of parsing the TMX
+        whenever neither it nor its tilesets have changed.
+
+        compact is passed on to the tile Layers; by default large layers are
+        compact.
+
+        If stream is true the file is parsed incrementally rather than read
+        whole, and the tile layers are streamed: their zlib or gzip
+        compressed data (or their part of the compiled map, which is mapped
+        into memory rather than read) is kept and only the regions the
+        viewport comes near are read out of it (see RegionGrid.) Layers
+        stored in other encodings are decoded whole.
+        '''
+        if stream:
+            digest = _file_digest(filename)
+        else:
+            with open(filename, 'rb') as f:
+                source = f.read()
+            digest = _digest(source)
+        if cache:
+            tilemap = load_compiled(filename, digest, viewport, compact, stream,
+                load_image)
+            if tilemap is not None:
+                return tilemap
+
+        if stream:
+            tilemap = cls.load_stream(filename, viewport, load_image)
+        else:
+            map = ElementTree.fromstring(source)
+
+            # get most general map informations and create a surface
+            tilemap = TileMap(viewport)
+            tilemap.set_size(int(map.attrib['width']),
+                int(map.attrib['height']), int(map.attrib['tilewidth']),
+                int(map.attrib['tileheight']))
+            tilemap.infinite = map.attrib.get('infinite') == '1'
+
+            for tag in map.findall('tileset'):
+                tilemap.tilesets.add(Tileset.fromxml(tag,
+                    load_image=load_image))
+
+            for tag in map.findall('layer'):
+                layer = Layer.fromxml(tag, tilemap, compact)
+                tilemap.layers.add_named(layer, layer.name)
 
-        # get most general map informations and create a surface
+            for tag in map.findall('objectgroup'):
+                layer = ObjectLayer.fromxml(tag, tilemap)
+                tilemap.layers.add_named(layer, layer.name)
+
+            if tilemap.infinite:
+                tilemap.fit_chunks()
+
+        if cache and not tilemap.infinite:
+            save_compiled(filename, digest, tilemap)
+        return tilemap
+
+    @classmethod
+    def load_stream(cls, filename, viewport, load_image=load_image):
+        '''Load the TMX file with streamed tile layers, parsing it one
+        top-level element at a time so the XML of only one tileset or layer
+        is held at once.
+        '''
         tilemap = TileMap(viewport)
-        tilemap.width = int(map.attrib['width'])
-        tilemap.height  = int(map.attrib['height'])
-        tilemap.tile_width = int(map.attrib['tilewidth'])
-        tilemap.tile_height = int(map.attrib['tileheight'])
-        tilemap.px_width = tilemap.width * tilemap.tile_width
-        tilemap.px_height = tilemap.height * tilemap.tile_height
-
-        for tag in map.findall('tileset'):
-            tilemap.tilesets.add(Tileset.fromxml(tag))
-
-        for tag in map.findall('layer'):
-            layer = Layer.fromxml(tag, tilemap)
+        # tile layers then object layers, as load() orders them
+        layers, object_layers = [], []
+        depth = 0
+        root = None
+        for event, tag in ElementTree.iterparse(filename, ('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = tag
+                    tilemap.set_size(int(tag.attrib['width']),
+                        int(tag.attrib['height']), int(tag.attrib['tilewidth']),
+                        int(tag.attrib['tileheight']))
+                    tilemap.infinite = tag.attrib.get('infinite') == '1'
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            if tag.tag == 'tileset':
+                tilemap.tilesets.add(Tileset.fromxml(tag,
+                    load_image=load_image))
+            elif tag.tag == 'layer':
+                layers.append(Layer.fromxml(tag, tilemap, streamed=True))
+            elif tag.tag == 'objectgroup':
+                object_layers.append(ObjectLayer.fromxml(tag, tilemap))
+            # done with this element and everything in it
+            root.remove(tag)
+        for layer in layers + object_layers:
             tilemap.layers.add_named(layer, layer.name)
+        if tilemap.infinite:
+            tilemap.fit_chunks()
+        return tilemap
 
-        for tag in map.findall('objectgroup'):
-            layer = ObjectLayer.fromxml(tag, tilemap)
-            tilemap.layers.add_named(layer, layer.name)
+    def set_size(self, width, height, tile_width, tile_height):
+        '''Set the dimensions of the map in cells and of its cells in
+        pixels.
+        '''
+        self.width = width
+        self.height = height
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.px_width = width * tile_width
+        self.px_height = height * tile_height
 
-        return tilemap
+    def fit_chunks(self):
+        '''Set the bounds of an infinite map to those of the chunks of its
+        tile layers.
+        '''
+        bounds = [layer.cells.bounds() for layer in self.layers
+            if isinstance(layer, Layer) and layer.infinite]
+        bounds = [b for b in bounds if b is not None]
+        if not bounds:
+            return
+        left = min(b[0] for b in bounds)
+        top = min(b[1] for b in bounds)
+        self.set_size(max(b[2] for b in bounds) - left,
+            max(b[3] for b in bounds) - top, self.tile_width, self.tile_height)
+        self.px_left = left * self.tile_width
+        self.px_top = top * self.tile_height
 
     _old_focus = None
     def set_focus(self, fx, fy, force=False):
@@ -746,26 +2777,28 @@ class TileMap(object):
         h = int(self.view_h)
         w2, h2 = w//2, h//2
 
+        left, top = self.px_left, self.px_top
+        right, bottom = left + self.px_width, top + self.px_height
         if self.px_width <= w:
             # this branch for centered view and no view jump when
             # crossing the center; both when world width <= view width
-            restricted_fx = self.px_width / 2
+            restricted_fx = left + self.px_width / 2
         else:
-            if (fx - w2) < 0:
-                restricted_fx = w2       # hit minimum X extent
-            elif (fx + w2) > self.px_width:
-                restricted_fx = self.px_width - w2       # hit maximum X extent
+            if (fx - w2) < left:
+                restricted_fx = left + w2       # hit minimum X extent
+            elif (fx + w2) > right:
+                restricted_fx = right - w2       # hit maximum X extent
             else:
                 restricted_fx = fx
         if self.px_height <= h:
             # this branch for centered view and no view jump when
             # crossing the center; both when world height <= view height
-            restricted_fy = self.px_height / 2
+            restricted_fy = top + self.px_height / 2
         else:
-            if (fy - h2) < 0:
-                restricted_fy = h2       # hit minimum Y extent
-            elif (fy + h2) > self.px_height:
-                restricted_fy = self.px_height - h2       # hit maximum Y extent
+            if (fy - h2) < top:
+                restricted_fy = top + h2       # hit minimum Y extent
+            elif (fy + h2) > bottom:
+                restricted_fy = bottom - h2       # hit maximum Y extent
             else:
                 restricted_fy = fy
 
@@ -831,8 +2864,234 @@ class TileMap(object):
         sx, sy = self.pixel_from_screen(x, y)
         return int(sx//self.tile_width), int(sy//self.tile_height)
 
-def load(filename, viewport):
-    return TileMap.load(filename, viewport)
+# Compiled maps.
+#
+# A compiled map holds everything TileMap.load() gets from a TMX file and its
+# external tilesets: the map dimensions, tileset metadata, the objects of the
+# object layers with their properties and the gid grid of each tile layer.
+# The file is a small JSON header followed by the grids as raw little-endian
+# 32-bit ints, which are read through a memory map:
+#
+#   "TMXC" | format version (uint32) | header length (uint32) | header |
+#   padding to 4 bytes | grids
+#
+# The header records a hash of the TMX and of each .tsx it uses; if any of
+# them change the compiled map is ignored and rebuilt.
+
+COMPILED_MAGIC = b'TMXC'
+COMPILED_VERSION = 1
+
+
+def compiled_filename(filename):
+    return os.path.splitext(filename)[0] + '.tmxc'
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save_compiled(filename, digest, tilemap):
+    '''Write the compiled form of the tilemap loaded from the TMX file
+    filename, whose contents have the digest given (see _digest().)
+    Failure to write is ignored.
+    '''
+    tilesets = []
+    for tileset in tilemap.tilesets.sets:
+        tiles = {}
+        for i, tile in enumerate(tileset.tiles):
+            if tile.properties:
+                tiles[str(i)] = tile.properties
+        tilesets.append(dict(name=tileset.name, firstgid=tileset.firstgid,
+            tile_width=tileset.tile_width, tile_height=tileset.tile_height,
+            images=tileset.images, tiles=tiles, source=tileset.source,
+            digest=tileset.source and _file_digest(tileset.source),
+            properties=tileset.properties))
+
+    layers = []
+    grids = []
+    offset = 0
+    for layer in tilemap.layers:
+        if isinstance(layer, Layer):
+            gids = layer.gids()
+            if sys.byteorder != 'little':
+                gids.byteswap()
+            layers.append(dict(kind='tiles', name=layer.name,
+                visible=layer.visible, offset=offset, count=len(gids)))
+            data = gids.tostring() if hasattr(gids, 'tostring') else gids.tobytes()
+            grids.append(data)
+            offset += len(data)
+        elif isinstance(layer, ObjectLayer):
+            objects = []
+            for o in layer.objects:
+                y = o.py + o.tile.tile_height if o.tile else o.py
+                objects.append([o.type, o.px, y, o.width, o.height, o.name,
+                    o.gid, o.visible, o.properties])
+            layers.append(dict(kind='objects', name=layer.name,
+                color=layer.color, opacity=layer.opacity,
+                visible=layer.visible, properties=layer.properties,
+                objects=objects))
+
+    header = json.dumps(dict(digest=digest, width=tilemap.width,
+        height=tilemap.height, tile_width=tilemap.tile_width,
+        tile_height=tilemap.tile_height, tilesets=tilesets,
+        layers=layers)).encode('utf-8')
+    header += b' ' * (-len(header) % 4)
+    # write to a temporary file renamed over the compiled map once complete,
+    # so a failed or interrupted write never leaves a damaged one behind
+    target = compiled_filename(filename)
+    try:
+        fd, temp = tempfile.mkstemp(suffix='.tmp',
+            dir=os.path.dirname(target) or '.')
+    except (IOError, OSError):
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(COMPILED_MAGIC)
+            f.write(struct.pack('<II', COMPILED_VERSION, len(header)))
+            f.write(header)
+            for data in grids:
+                f.write(data)
+        if os.path.exists(target) and sys.platform == 'win32':
+            os.remove(target)
+        os.rename(temp, target)
+    except (IOError, OSError):
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+
+
+def load_compiled(filename, digest, viewport, compact=None, stream=False,
+        load_image=load_image):
+    '''Load the compiled form of the TMX file filename, whose contents have
+    the digest given (see _digest().)
+
+    Return a TileMap or None if there is no up to date compiled map. The
+    streamed layers of the map read their tiles straight from the mapped
+    file, which stays open until they are gone.
+    '''
+    try:
+        f = open(compiled_filename(filename), 'rb')
+    except (IOError, OSError):
+        return None
+    with f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            return None
+    tilemap = None
+    try:
+        if data[:4] != COMPILED_MAGIC or len(data) < 12:
+            return None
+        version, length = struct.unpack('<II', data[4:12])
+        if version != COMPILED_VERSION or 12 + length > len(data):
+            return None
+        try:
+            header = json.loads(data[12:12 + length].decode('utf-8'))
+        except ValueError:
+            return None
+        if header['digest'] != digest:
+            return None
+        # a truncated file is as good as no compiled map
+        for info in header['layers']:
+            if info['kind'] == 'tiles' and 12 + length + info['offset'] + \
+                    4 * info['count'] > len(data):
+                return None
+        for info in header['tilesets']:
+            if info['source'] and (not os.path.exists(info['source']) or
+                    _file_digest(info['source']) != info['digest']):
+                return None
+        tilemap = _build_compiled(header, data, 12 + length, viewport,
+            compact, stream, load_image)
+    finally:
+        if tilemap is None or not stream:
+            data.close()
+    return tilemap
+
+
+def _build_tileset(info, load_image):
+    tileset = Tileset(info['name'], info['tile_width'], info['tile_height'],
+        info['firstgid'])
+    tileset.source = info['source']
+    tileset.properties = info['properties']
+    for image in info['images']:
+        tileset.add_image(image, load_image)
+    for i, properties in info['tiles'].items():
+        tileset.tiles[int(i)].properties = properties
+    return tileset
+
+
+def _build_compiled(header, data, start, viewport, compact, stream,
+        load_image):
+    tilemap = TileMap(viewport)
+    tilemap.set_size(header['width'], header['height'], header['tile_width'],
+        header['tile_height'])
+
+    for info in header['tilesets']:
+        if info['source']:
+            tileset = registry.get(info['source'], info['firstgid'],
+                lambda: _build_tileset(info, load_image))
+        else:
+            tileset = _build_tileset(info, load_image)
+        tilemap.tilesets.add(tileset)
+
+    for info in header['layers']:
+        if info['kind'] == 'tiles':
+            layer = Layer(info['name'], info['visible'], tilemap, compact,
+                stream)
+            offset = start + info['offset']
+            if stream:
+                layer.set_source(BufferSource(data, offset))
+            else:
+                layer.set_gids(gid_array(data[offset:offset +
+                    4 * info['count']]), tilemap)
+        else:
+            objects = []
+            for (type, x, y, w, h, name, gid, visible,
+                    properties) in info['objects']:
+                tile = tilemap.tilesets[gid] if gid else None
+                o = Object(type, x, y, w, h, name, gid, tile, visible)
+                o.properties = properties
+                objects.append(o)
+            layer = ObjectLayer(info['name'], info['color'], objects,
+                info['opacity'], info['visible'])
+            layer.properties = info['properties']
+        tilemap.layers.add_named(layer, layer.name)
+    return tilemap
+
+
+def tileset_images(filename):
+    '''Return the image files of the tilesets used by the TMX file, reading
+    only as far as its first layer.
+    '''
+    images = []
+    with open(filename, 'rb') as f:
+        for event, tag in ElementTree.iterparse(f, ('start', 'end')):
+            if event == 'start':
+                if tag.tag in ('layer', 'objectgroup'):
+                    break
+                continue
+            if tag.tag != 'tileset':
+                continue
+            if 'source' in tag.attrib:
+                tag = ElementTree.parse(tag.attrib['source']).getroot()
+            images.extend(image.attrib['source']
+                for image in tag.findall('image'))
+    return images
+
+
+def load(filename, viewport, cache=True, compact=None, stream=False,
+        load_image=load_image):
+    return TileMap.load(filename, viewport, cache, compact, stream,
+        load_image)
 
 if __name__ == '__main__':
     # allow image load to work